@@ -1,7 +1,9 @@
 import re
 import os
 import json
+import shutil
 import time
+import threading
 
 from operator import itemgetter
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, SystemMessagePromptTemplate, AIMessagePromptTemplate, PromptTemplate, MessagesPlaceholder
@@ -10,6 +12,7 @@ from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.documents import Document
 from adjustment.openai import ChatOpenAI
 from embedding import Embedding
+from store import StoreVersions
 
 class PAIMON:
     name: str
@@ -21,6 +24,11 @@ class PAIMON:
     memory = None
     prompt = None
     embedding = None
+    previous = None
+    versions = None
+    lock = None
+    rebuilding = None
+    rebuild_error = None
 
     def __init__(self, memory_window=5, bot_name="PAIMON", verbose=False):
         self.name = bot_name
@@ -31,7 +39,16 @@ class PAIMON:
             openai_api_key="EMPTY",
             streaming=False
         )
-        self.embedding = Embedding(512, 128, self.name)
+        # 向量库按版本保存，可以在后台构建新版本后切换，见 rebuild
+        self.versions = StoreVersions("./faiss_{}_versions".format(self.name))
+        self.lock = threading.Lock()
+        current = self.versions.current()
+        if current is None:
+            # 第一次启动时，把原有的向量库作为第一个版本
+            current = self.versions.create("./faiss_{}".format(self.name))
+            self.versions.publish(current)
+        # Flask 多线程处理请求，并发的查询合并为一次嵌入
+        self.embedding = Embedding(512, 128, self.name, path=current, batch_window=0.005)
         self.memory_window = memory_window
         self.build_chain()
 
@@ -42,6 +59,81 @@ class PAIMON:
         else:
             print(f"向量库加载失败，未创建过向量库“{self.name}”，且未加入任何文件，将无法进行搜索。")
     
+    def rebuild(self, file_list:list=[], extend:bool=True) -> bool:
+        """
+            在后台线程中构建新版本的向量库，构建完成后再替换当前向量库，构建期间仍使用当前向量库回答问题
+            extend: 为 True 时在当前向量库的基础上加入文件，否则只用 file_list 新建向量库
+
+            返回：是否开始构建，已有构建任务在进行时返回 False
+        """
+        with self.lock:
+            if self.rebuilding is not None and self.rebuilding.is_alive():
+                return False
+            self.rebuild_error = None
+            self.rebuilding = threading.Thread(target=self.build_version, args=(file_list, extend), daemon=True)
+            self.rebuilding.start()
+            return True
+
+    def build_version(self, file_list:list, extend:bool):
+        start_time = time.time()
+        path, embedding = None, None
+        try:
+            current = self.embedding
+            current.store.wait()
+            path = self.versions.create(current.store.path if extend else None)
+            print("开始构建向量库新版本：", path)
+            embedding = Embedding(
+                512, 128, self.name, path=path,
+                embedding_model=current.embedding_model, query_cache_size=0
+            )
+            # 嵌入模型相同，查询向量缓存和查询批处理可以继续使用
+            embedding.query_cache = current.query_cache
+            embedding.dispatcher = current.dispatcher
+            embedding.load(file_list)
+            embedding.store.wait()
+            if embedding.vec_db is None:
+                raise RuntimeError("新版本向量库为空，不会发布")
+            self.swap(embedding)
+            print("向量库新版本构建完成，耗时：", time.time() - start_time)
+        except Exception as e:
+            self.rebuild_error = repr(e)
+            print("向量库新版本构建失败：", self.rebuild_error)
+            # 构建失败的版本不会发布，删除它的目录，避免在清理旧版本时占用保留的名额
+            if embedding is not None:
+                embedding.store.wait()
+            if path is not None:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def swap(self, embedding:Embedding):
+        """
+            原子地切换当前向量库，原来的向量库保留在内存中用于回滚
+            正在处理的请求仍使用切换前的向量库，之后的请求使用新的向量库
+        """
+        with self.lock:
+            # 切换后原来的向量库成为上一个版本，清理旧版本时不能删除它的目录
+            self.versions.publish(embedding.store.path, [self.embedding.store.path])
+            self.previous, self.embedding = self.embedding, embedding
+
+    def rollback(self) -> bool:
+        """
+            切换回上一个版本的向量库
+
+            返回：是否存在上一个版本
+        """
+        if self.previous is None:
+            return False
+        self.swap(self.previous)
+        return True
+
+    def status(self) -> dict:
+        return {
+            "current": self.embedding.store.path,
+            "previous": self.previous.store.path if self.previous is not None else None,
+            "versions": self.versions.versions(),
+            "building": self.rebuilding is not None and self.rebuilding.is_alive(),
+            "error": self.rebuild_error
+        }
+
     def clear_history(self):
         if self.memory is not None:
             self.memory.clear()
@@ -101,8 +193,10 @@ class PAIMON:
         )
     
     def search(self, question:str):
-        if self.embedding.vec_db is not None:
-            return self.embedding.search(question, 0.5)
+        # 只读取一次，搜索过程中向量库被切换也不受影响
+        embedding = self.embedding
+        if embedding.vec_db is not None:
+            return embedding.range_search(question, 0.5, 5)
         else:
             return []
 
@@ -150,6 +244,24 @@ def clear():
     chatbot.clear_history()
     return "OK"
 
+@app.route("/admin/rebuild", methods=["POST"])
+def admin_rebuild():
+    started = chatbot.rebuild(
+        file_list = request.json.get("files", []),
+        extend = request.json.get("extend", True)
+    )
+    return jsonify(chatbot.status()), 202 if started else 409
+
+@app.route("/admin/rollback", methods=["POST"])
+def admin_rollback():
+    if chatbot.rollback():
+        return jsonify(chatbot.status())
+    return jsonify(chatbot.status()), 409
+
+@app.route("/admin/status", methods=["GET"])
+def admin_status():
+    return jsonify(chatbot.status())
+
 if __name__ == "__main__":
     # dir_list, name_list = ["./data/", "./data/website/"], []
     # for i in dir_list:
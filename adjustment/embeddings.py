@@ -1,6 +1,119 @@
+import os
 from typing import Any, List, Optional
 from langchain_core.embeddings import Embeddings
 from langchain_core.pydantic_v1 import BaseModel, Extra
+
+class CPUEncoder:
+    """CPU inference for BERT-style sentence embedding models such as GTE.
+
+    The embedding is the normalized [CLS] vector of the last hidden state,
+    the same as the ModelScope sentence embedding pipeline. Instances are
+    called like that pipeline, so ``ModelScopeEmbeddings`` can use either.
+
+    Backends:
+        torch-int8: PyTorch with ``torch.quantization.quantize_dynamic``
+            applied to every ``nn.Linear`` layer.
+        onnx: ONNX Runtime on a graph exported once to ``{model_dir}/onnx``.
+        onnx-int8: the exported graph with int8 dynamic quantized weights.
+    """
+
+    backends = ["torch-int8", "onnx", "onnx-int8"]
+
+    def __init__(self, model_dir: str, sequence_length: int, backend: str, num_threads: Optional[int] = None):
+        try:
+            import torch
+            from transformers import AutoModel, AutoTokenizer
+        except ImportError as e:
+            raise ImportError(
+                "Could not import some python packages."
+                "Please install it with `pip install torch transformers`."
+            ) from e
+        if backend not in self.backends:
+            raise ValueError("Unsupported backend: {}".format(backend))
+        self.backend = backend
+        self.sequence_length = sequence_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        model = AutoModel.from_pretrained(model_dir).eval()
+        if backend == "torch-int8":
+            self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            return
+
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError(
+                "Could not import onnxruntime python package."
+                "Please install it with `pip install onnxruntime`."
+            ) from e
+        path = self.export(model, os.path.join(model_dir, "onnx"), backend == "onnx-int8")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    @staticmethod
+    def export(model: Any, onnx_dir: str, quantize: bool = False) -> str:
+        """Export the model with pooling to ONNX, reusing earlier exports."""
+        import torch
+
+        class Pooler(torch.nn.Module):
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+
+            def forward(self, input_ids, attention_mask, token_type_ids):
+                hidden = self.model(
+                    input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids
+                )[0][:, 0]
+                return torch.nn.functional.normalize(hidden, p=2, dim=1)
+
+        os.makedirs(onnx_dir, exist_ok=True)
+        path = os.path.join(onnx_dir, "model.onnx")
+        if not os.path.exists(path):
+            dummy = torch.ones((1, 8), dtype=torch.long)
+            axes = {0: "batch", 1: "sequence"}
+            torch.onnx.export(
+                Pooler(model), (dummy, dummy, torch.zeros_like(dummy)), path,
+                input_names=["input_ids", "attention_mask", "token_type_ids"],
+                output_names=["text_embedding"],
+                dynamic_axes={
+                    "input_ids": axes, "attention_mask": axes, "token_type_ids": axes,
+                    "text_embedding": {0: "batch"}
+                },
+                opset_version=14
+            )
+        if not quantize:
+            return path
+        quantized = os.path.join(onnx_dir, "model.int8.onnx")
+        if not os.path.exists(quantized):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(path, quantized, weight_type=QuantType.QInt8)
+        return quantized
+
+    def encode(self, texts: List[str]) -> Any:
+        """Return the normalized embeddings of texts as a float32 numpy array."""
+        if self.backend == "torch-int8":
+            import torch
+            inputs = self.tokenizer(
+                texts, padding=True, truncation=True, max_length=self.sequence_length, return_tensors="pt"
+            )
+            with torch.inference_mode():
+                hidden = self.model(**inputs)[0][:, 0]
+                return torch.nn.functional.normalize(hidden, p=2, dim=1).numpy()
+        inputs = self.tokenizer(
+            texts, padding=True, truncation=True, max_length=self.sequence_length, return_tensors="np"
+        )
+        feed = {name: inputs[name].astype("int64") for name in self.input_names}
+        return self.session.run(["text_embedding"], feed)[0]
+
+    def __call__(self, input: dict) -> dict:
+        return {"text_embedding": self.encode(input["source_sentence"])}
+
 class ModelScopeEmbeddings(BaseModel, Embeddings):
     """ModelScopeHub embedding models.
 
@@ -18,10 +131,23 @@ class ModelScopeEmbeddings(BaseModel, Embeddings):
     model_id: str = "damo/nlp_corom_sentence-embedding_english-base"
     """Model name to use."""
     model_revision: Optional[str] = None
+    backend: str = "modelscope"
+    """Inference backend: modelscope, or one of the CPU backends of CPUEncoder."""
+    num_threads: Optional[int] = None
+    """Intra-op threads of the CPU backends, None to use the library default."""
+    sequence_length: int = 512
+    """Maximum number of tokens the model reads from a text."""
+    max_batch_tokens: Optional[int] = None
+    """Padded tokens allowed in one forward pass of embed_documents.
+    Texts are sorted by length and cut into batches under this budget, so
+    short texts are not padded to the longest one. None sends one batch."""
 
     def __init__(self, sequence_length, **kwargs: Any):
         """Initialize the modelscope"""
-        super().__init__(**kwargs)
+        super().__init__(sequence_length=sequence_length, **kwargs)
+        if self.backend != "modelscope":
+            self.embed = CPUEncoder(self.model_dir(), sequence_length, self.backend, self.num_threads)
+            return
         try:
             from modelscope.pipelines import pipeline
             from modelscope.utils.constant import Tasks
@@ -37,6 +163,13 @@ class ModelScopeEmbeddings(BaseModel, Embeddings):
             sequence_length=sequence_length
         )
 
+    def model_dir(self) -> str:
+        """Local directory of the model, downloading it from ModelScope if needed."""
+        if os.path.isdir(self.model_id):
+            return self.model_id
+        from modelscope.hub.snapshot_download import snapshot_download
+        return snapshot_download(self.model_id, revision=self.model_revision)
+
     class Config:
         """Configuration for this pydantic object."""
 
@@ -52,9 +185,34 @@ class ModelScopeEmbeddings(BaseModel, Embeddings):
             List of embeddings, one for each text.
         """
         texts = list(map(lambda x: x.replace("\n", " "), texts))
-        inputs = {"source_sentence": texts}
-        embeddings = self.embed(input=inputs)["text_embedding"]
-        return embeddings.tolist()
+        if self.max_batch_tokens is None or len(texts) <= 1:
+            inputs = {"source_sentence": texts}
+            embeddings = self.embed(input=inputs)["text_embedding"]
+            return embeddings.tolist()
+
+        embeddings: List[Any] = [None] * len(texts)
+        for batch in self.buckets(texts):
+            inputs = {"source_sentence": [texts[i] for i in batch]}
+            for i, embedding in zip(batch, self.embed(input=inputs)["text_embedding"]):
+                embeddings[i] = embedding.tolist()
+        return embeddings
+
+    def buckets(self, texts: List[str]) -> List[List[int]]:
+        """Split the indices of texts into length-sorted batches.
+
+        The length of a text is estimated as its characters plus [CLS] and
+        [SEP], which is close to the token count for Chinese text. A batch is
+        closed before its padded size, count times the longest length,
+        would exceed max_batch_tokens.
+        """
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        batches: List[List[int]] = [[]]
+        for i in order:
+            length = min(len(texts[i]) + 2, self.sequence_length)
+            if len(batches[-1]) > 0 and length * (len(batches[-1]) + 1) > self.max_batch_tokens:
+                batches.append([])
+            batches[-1].append(i)
+        return batches
 
     def embed_query(self, text: str) -> List[float]:
         """Compute query embeddings using a modelscope embedding model.
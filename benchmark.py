@@ -0,0 +1,460 @@
+import os
+import re
+import json
+import time
+import pickle
+import shutil
+import threading
+import tracemalloc
+
+import faiss
+import numpy as np
+
+from data import LoadFile, TokenCounter, TextSplitter, QAJsonLoader, iter_load_file
+from embedding import Embedding, create_embedding_model
+from store import SegmentStore, index_config, create_index
+from dispatcher import EmbeddingDispatcher
+
+"""
+    一些性能测试，用来比较不同实现的速度
+    测试会在当前目录下创建 faiss_BENCH_* 向量库，测试结束后删除
+"""
+
+def remove_db(db_name:str):
+    if os.path.exists("./faiss_{}".format(db_name)):
+        shutil.rmtree("./faiss_{}".format(db_name))
+
+def bench_load(paths:list, batch_size:int=64):
+    """
+        比较逐个文本块嵌入和批量嵌入两种加载方式的速度
+    """
+    result = {}
+    for mode, bulk in [("each", False), ("bulk", True)]:
+        db_name = "BENCH_" + mode.upper()
+        remove_db(db_name)
+        a = Embedding(size=512, cover=128, db_name=db_name, cache_path=None)
+        start_time = time.time()
+        a.load(paths, bulk=bulk, batch_size=batch_size)
+        cost = time.time() - start_time
+        count = a.vec_db.index.ntotal if a.vec_db is not None else 0
+        result[mode] = (count, cost)
+        remove_db(db_name)
+
+    for mode, (count, cost) in result.items():
+        print("[{}] {} chunk(s), {:.2f}s, {:.1f} chunks/s".format(
+            mode, count, cost, count / cost if cost > 0 else float("inf")))
+    print("Speedup: {:.2f}x".format(result["each"][1] / result["bulk"][1]))
+    return result
+
+def bench_cache(paths:list, cache_path:str="./bench_cache.db"):
+    """
+        比较无缓存和有缓存两种情况下重建向量库的速度
+    """
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    result = {}
+    for mode in ["cold", "warm"]:
+        remove_db("BENCH_CACHE")
+        a = Embedding(size=512, cover=128, db_name="BENCH_CACHE", cache_path=cache_path)
+        start_time = time.time()
+        a.load(paths)
+        result[mode] = (time.time() - start_time, a.cache.stats())
+        a.cache.conn.close()
+        remove_db("BENCH_CACHE")
+    os.remove(cache_path)
+
+    for mode, (cost, stats) in result.items():
+        print("[{}] {:.2f}s, {} hit(s), {} miss(es)".format(mode, cost, stats["hits"], stats["misses"]))
+    return result
+
+def bench_startup(db_name:str, repeat:int=5):
+    """
+        比较完整加载和内存映射加载向量库的耗时，向量库需要先通过 save() 合并
+    """
+    a = Embedding(size=512, cover=128, db_name=db_name, cache_path=None, mmap=True)
+    result = {}
+    for mode in ["full", "mmap"]:
+        start_time = time.time()
+        for _ in range(repeat):
+            store = SegmentStore("./faiss_{}".format(db_name))
+            if mode == "full":
+                store.load_base(a.embedding_model)
+            else:
+                store.load_mmap(a.embedding_model)
+        result[mode] = (time.time() - start_time) / repeat
+        print("[{}] {:.4f}s".format(mode, result[mode]))
+    return result
+
+def corpus_vectors(db_name:str, queries_path:str="./南哪23级本科①群.txt.qa"):
+    """
+        读取向量库中的所有向量，并嵌入测试问题
+
+        返回：(向量库中的向量, 问题的向量)
+    """
+    a = Embedding(size=512, cover=128, db_name=db_name)
+    vectors = a.vec_db.index.reconstruct_n(0, a.vec_db.index.ntotal)
+    questions = [item["Q"] for item in json.load(open(queries_path, "r", encoding="utf-8"))]
+    queries = np.array(a.embed_texts(questions), dtype=np.float32)
+    return vectors, queries
+
+def bench_index(db_name:str="QA", configs:list=None, k:int=5):
+    """
+        比较不同索引类型的构建时间、QPS 和相对于暴力搜索的 recall@k
+        db_name: 提供测试向量的向量库，需要是暴力搜索索引
+        configs: [(索引类型, 参数)] 列表
+    """
+    if configs is None:
+        configs = [
+            ("flat", {}),
+            ("ivf", {"nlist": 16, "nprobe": 1}),
+            ("ivf", {"nlist": 16, "nprobe": 4}),
+            ("hnsw", {"M": 16, "efSearch": 16}),
+            ("hnsw", {"M": 32, "efSearch": 64})
+        ]
+    vectors, queries = corpus_vectors(db_name)
+    truth = None
+    result = []
+    for index_type, params in configs:
+        config = index_config(index_type, params)
+        start_time = time.time()
+        index = create_index(vectors.shape[1], config, vectors)
+        index.add(vectors)
+        build = time.time() - start_time
+
+        start_time = time.time()
+        _, ids = index.search(queries, k)
+        qps = len(queries) / (time.time() - start_time)
+        if truth is None:
+            truth = ids
+        recall = np.mean([len(set(ids[i]) & set(truth[i])) / k for i in range(len(queries))])
+        result.append((index_type, config["params"], build, qps, recall))
+        print("[{} {}] build {:.3f}s, {:.0f} QPS, recall@{} {:.3f}".format(
+            index_type, config["params"], build, qps, k, recall))
+    return result
+
+def bench_codec(db_name:str="QA", configs:list=None, k:int=5):
+    """
+        比较不同压缩方式的索引大小、QPS 和相对于不压缩的暴力搜索的 recall@k
+        configs: [(压缩方式, 参数)] 列表
+    """
+    if configs is None:
+        configs = [
+            ("float32", {}),
+            ("float16", {}),
+            ("int8", {}),
+            ("pq", {"pq_m": 64}),
+            ("pq", {"pq_m": 64, "refine": "float16", "k_factor": 4}),
+            ("pq", {"pq_m": 64, "refine": "flat", "k_factor": 4})
+        ]
+    vectors, queries = corpus_vectors(db_name)
+    truth = None
+    result = []
+    for codec, params in configs:
+        config = index_config("flat", params, codec)
+        index = create_index(vectors.shape[1], config, vectors)
+        index.add(vectors)
+        size = len(faiss.serialize_index(index))
+
+        start_time = time.time()
+        _, ids = index.search(queries, k)
+        qps = len(queries) / (time.time() - start_time)
+        if truth is None:
+            truth = ids
+        recall = np.mean([len(set(ids[i]) & set(truth[i])) / k for i in range(len(queries))])
+        result.append((codec, config["params"], size, qps, recall))
+        print("[{} {}] {:.1f} KB, {:.0f} bytes/vector, {:.0f} QPS, recall@{} {:.3f}".format(
+            codec, config["params"], size / 1024, size / len(vectors), qps, k, recall))
+    return result
+
+def bench_search_many(db_name:str="QA", queries_path:str="./南哪23级本科①群.txt.qa"):
+    """
+        比较逐个调用 search 和一次调用 search_many 的速度
+    """
+    a = Embedding(size=512, cover=128, db_name=db_name, cache_path=None)
+    questions = [item["Q"] for item in json.load(open(queries_path, "r", encoding="utf-8"))]
+
+    start_time = time.time()
+    loop = [a.search(q) for q in questions]
+    loop_cost = time.time() - start_time
+
+    start_time = time.time()
+    batch = a.search_many(questions)
+    batch_cost = time.time() - start_time
+
+    same = all([[d.page_content for d in x] == [d.page_content for d in y] for x, y in zip(loop, batch)])
+    print("[search] {} question(s), {:.2f}s, {:.1f} QPS".format(len(questions), loop_cost, len(questions) / loop_cost))
+    print("[search_many] {} question(s), {:.2f}s, {:.1f} QPS".format(len(questions), batch_cost, len(questions) / batch_cost))
+    print("Speedup: {:.2f}x, same result: {}".format(loop_cost / batch_cost, same))
+    return loop_cost, batch_cost
+
+def bench_qa_layout(paths:list=["./南哪QA.qa"]):
+    """
+        比较 qa 文件两种划分方式的嵌入耗时、向量数量、索引大小和文档库大小
+    """
+    result = {}
+    for layout in ["chunk", "question"]:
+        db_name = "BENCH_" + layout.upper()
+        remove_db(db_name)
+        a = Embedding(size=512, cover=128, db_name=db_name, cache_path=None, qa_layout=layout)
+        start_time = time.time()
+        a.load(paths)
+        cost = time.time() - start_time
+        index = len(faiss.serialize_index(a.vec_db.index))
+        docstore = len(pickle.dumps(a.vec_db.docstore))
+        answers = sum([len(i.encode()) for i in a.answers.answers.values()]) if a.answers is not None else 0
+        result[layout] = (a.vec_db.index.ntotal, cost, index, docstore + answers)
+        remove_db(db_name)
+
+    for layout, (count, cost, index, docstore) in result.items():
+        print("[{}] {} vector(s), {:.2f}s, index {:.1f} KB, documents {:.1f} KB".format(
+            layout, count, cost, index / 1024, docstore / 1024))
+    return result
+
+def bench_pipeline(paths:list, workers:int=4, batch_size:int=64):
+    """
+        比较串行批量加载和流水线并行加载的速度，两者得到的向量数量应当相同
+    """
+    result = {}
+    for mode, n in [("serial", None), ("pipeline", workers)]:
+        db_name = "BENCH_" + mode.upper()
+        remove_db(db_name)
+        a = Embedding(size=512, cover=128, db_name=db_name, cache_path=None)
+        start_time = time.time()
+        a.load(paths, batch_size=batch_size, workers=n)
+        cost = time.time() - start_time
+        count = a.vec_db.index.ntotal if a.vec_db is not None else 0
+        a.store.wait()
+        result[mode] = (count, cost)
+        remove_db(db_name)
+
+    for mode, (count, cost) in result.items():
+        print("[{}] {} chunk(s), {:.2f}s, {:.1f} chunks/s".format(
+            mode, count, cost, count / cost if cost > 0 else float("inf")))
+    print("Speedup: {:.2f}x".format(result["serial"][1] / result["pipeline"][1]))
+    return result
+
+def bench_backend(
+    paths:list=["./南哪QA.qa"], backends:list=["torch-int8", "onnx", "onnx-int8"],
+    num_threads:int=None, batch_size:int=32, sample:int=256, tolerance:dict=None
+):
+    """
+        比较嵌入模型各推理后端的吞吐量，并以 modelscope 后端的向量为参照检查一致性
+        一致性为每个文本块的两个向量的余弦相似度，给出平均值和最小值
+        tolerance: 各后端余弦相似度最小值的下限，为 None 时 onnx 为 0.99，量化后端为 0.95，
+            有后端低于下限时抛出 RuntimeError，池化或归一化方式错误的后端会在这里被发现
+    """
+    if tolerance is None:
+        tolerance = {"onnx": 0.99, "torch-int8": 0.95, "onnx-int8": 0.95}
+    texts = []
+    for path in paths:
+        texts += [doc.page_content for doc in LoadFile(path, 512, 128)]
+    texts = texts[:sample]
+
+    result, reference = {}, None
+    for backend in ["modelscope"] + backends:
+        model = create_embedding_model(512, backend, num_threads)
+        model.embed_documents(texts[:batch_size])
+        start_time = time.time()
+        vectors = []
+        for i in range(0, len(texts), batch_size):
+            vectors += model.embed_documents(texts[i : i+batch_size])
+        cost = time.time() - start_time
+        vectors = np.array(vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        if reference is None:
+            reference = vectors
+        cosine = np.sum(vectors * reference, axis=1)
+        result[backend] = (len(texts) / cost, float(cosine.mean()), float(cosine.min()))
+
+    failed = []
+    for backend, (speed, mean, low) in result.items():
+        print("[{}] {:.1f} chunks/s, cosine mean {:.4f}, min {:.4f}".format(backend, speed, mean, low))
+        if low < tolerance.get(backend, -1.0):
+            failed.append("{} (min {:.4f} < {})".format(backend, low, tolerance[backend]))
+    if len(failed) > 0:
+        raise RuntimeError("嵌入向量与 modelscope 后端不一致：{}".format(", ".join(failed)))
+    return result
+
+def bench_dispatcher(concurrency:int=16, count:int=512, window:float=0.005, max_batch:int=32):
+    """
+        concurrency 个线程同时嵌入查询，比较逐个调用 embed_query 和经过 EmbeddingDispatcher 合并的吞吐量和延迟
+    """
+    qa = json.load(open("./南哪QA.qa", "r", encoding="utf-8"))
+    questions = [item["conversations"][0]["value"] for item in qa]
+    questions = (questions * (count // max(len(questions), 1) + 1))[:count]
+    model = create_embedding_model(512)
+    dispatcher = EmbeddingDispatcher(model, window, max_batch)
+
+    result = {}
+    for mode, embed in [("direct", model.embed_query), ("dispatcher", dispatcher.embed_query)]:
+        latency = []
+        def worker(part):
+            for question in part:
+                start_time = time.time()
+                embed(question)
+                latency.append(time.time() - start_time)
+        threads = [threading.Thread(target=worker, args=(questions[i::concurrency],)) for i in range(concurrency)]
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cost = time.time() - start_time
+        result[mode] = (count / cost, float(np.percentile(latency, 50)), float(np.percentile(latency, 99)))
+
+    for mode, (qps, p50, p99) in result.items():
+        print("[{}] {:.1f} queries/s, p50 {:.1f} ms, p99 {:.1f} ms".format(mode, qps, p50 * 1000, p99 * 1000))
+    print("Average batch: {average_batch:.1f}".format(**dispatcher.stats()))
+    return result
+
+def bench_bucketing(paths:list=["./南哪QA.qa"], batch_size:int=64, max_batch_tokens:int=8192):
+    """
+        比较按输入顺序每 batch_size 个文本一批，和按长度分桶两种方式的嵌入速度和填充比例
+        填充比例 = 实际 token 数 / 填充后的 token 数，token 数以字符数 + 2 估计
+    """
+    texts = []
+    for path in paths:
+        texts += [doc.page_content for doc in LoadFile(path, 512, 128)]
+    lengths = [min(len(text) + 2, 512) for text in texts]
+    print("{} chunk(s), length min {}, median {}, max {}".format(
+        len(texts), min(lengths), int(np.median(lengths)), max(lengths)))
+
+    result = {}
+    for mode, tokens in [("fixed", None), ("bucketed", max_batch_tokens)]:
+        model = create_embedding_model(512, max_batch_tokens=tokens)
+        if tokens is None:
+            batches = [list(range(i, min(i + batch_size, len(texts)))) for i in range(0, len(texts), batch_size)]
+        else:
+            batches = model.buckets(texts)
+        padded = sum([len(batch) * max([lengths[i] for i in batch]) for batch in batches])
+        start_time = time.time()
+        if tokens is None:
+            vectors = []
+            for batch in batches:
+                vectors += model.embed_documents([texts[i] for i in batch])
+        else:
+            vectors = model.embed_documents(texts)
+        cost = time.time() - start_time
+        result[mode] = (cost, len(batches), sum(lengths) / padded, np.array(vectors, dtype=np.float32))
+
+    same = np.allclose(result["fixed"][3], result["bucketed"][3], atol=1e-4)
+    for mode, (cost, count, efficiency, _) in result.items():
+        print("[{}] {:.2f}s, {:.1f} chunks/s, {} batch(es), padding efficiency {:.1%}".format(
+            mode, cost, len(texts) / cost, count, efficiency))
+    print("Speedup: {:.2f}x, same vectors: {}".format(result["fixed"][0] / result["bucketed"][0], same))
+    return result
+
+def bench_length_mode(paths:list=None, size:int=512, cover:int=128):
+    """
+        比较按字符数和按 token 数划分文本块：文本块数量、token 数分布、被截断的文本块数量和嵌入耗时
+    """
+    if paths is None:
+        paths = ["./南哪QA.qa"] + ["./data/" + i for i in os.listdir("./data/") if os.path.isfile("./data/" + i)]
+    model = create_embedding_model(size)
+    tokenizer = model.model_dir()
+    counter = TokenCounter.get(tokenizer)
+
+    result = {}
+    for mode in ["char", "token"]:
+        texts = []
+        for path in paths:
+            docs = LoadFile(path, size, cover, tokenizer=tokenizer if mode == "token" else None)
+            texts += [doc.page_content for doc in docs]
+        tokens = np.array(counter.count_many(texts)) + 2
+        start_time = time.time()
+        for i in range(0, len(texts), 64):
+            model.embed_documents(texts[i : i+64])
+        cost = time.time() - start_time
+        result[mode] = (len(texts), float(tokens.mean()), int((tokens > size).sum()), cost)
+
+    for mode, (count, mean, truncated, cost) in result.items():
+        print("[{}] {} chunk(s), {:.1f} tokens/chunk, {} truncated, embedding {:.2f}s".format(
+            mode, count, mean, truncated, cost))
+    return result
+
+def bench_streaming(path:str="./data/【2023级本科生】新生入学教务活动安排.md", repeats:list=[1, 16, 64]):
+    """
+        比较 LoadFile 和 iter_load_file 划分大文件时的峰值内存，文件由 path 重复 repeats 次构成
+    """
+    with open(path, "r", encoding="utf-8") as file_input:
+        content = file_input.read()
+    result = {}
+    for repeat in repeats:
+        with open("./BENCH_stream.txt", "w", encoding="utf-8") as file_output:
+            for _ in range(repeat):
+                file_output.write(content + "\n")
+        for mode in ["list", "stream"]:
+            tracemalloc.start()
+            start_time = time.time()
+            if mode == "list":
+                count = len(LoadFile("./BENCH_stream.txt", 512, 128))
+            else:
+                count = sum(1 for _ in iter_load_file("./BENCH_stream.txt", 512, 128, window=64*1024))
+            cost = time.time() - start_time
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            result[(repeat, mode)] = (count, peak, cost)
+            print("[x{} {}] {} chunk(s), peak {:.1f} MB, {:.2f}s".format(repeat, mode, count, peak / 1024 / 1024, cost))
+    os.remove("./BENCH_stream.txt")
+    return result
+
+def legacy_normalize(content:str) -> list[tuple]:
+    """
+        原来的过滤和链接划分：strip、两次 re.sub，再插入 $url$ 标记后 split，正则表达式每次以字符串传入
+    """
+    content = content.strip()
+    content = re.sub(r"[\t\f\v\r \xa0]+", " ", content)
+    content = re.sub(r"[\n]+", "\n", content)
+    url_pattern = r"(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)"
+    content = re.sub(url_pattern, r"$url$\1$url$", content)
+    return [(i, i[0:4] == "http") for i in [i.strip() for i in content.split("$url$")]]
+
+def bench_normalize(paths:list=None, repeat:int=20):
+    """
+        比较原来的过滤、链接划分和预编译的 TextSplitter.filter、url_splitter 的速度，并检查结果是否相同
+        paths 中的 .qa 文件以每条记录的问题和答案作为输入，其它文件以整个文件内容作为输入
+    """
+    if paths is None:
+        paths = ["./南哪QA.qa"] + ["./data/" + i for i in os.listdir("./data/") if i.endswith((".md", ".txt"))]
+    splitter = TextSplitter(512, 128)
+    inputs = {"data": [], "qa": []}
+    for path in paths:
+        if path.endswith(".qa"):
+            inputs["qa"] += [
+                item["value"] for qa in QAJsonLoader(path, "utf-8").iter_records() for item in qa["conversations"]]
+        else:
+            with open(path, "r", encoding="utf-8") as file_input:
+                inputs["data"].append(file_input.read())
+
+    result = {}
+    for name, contents in inputs.items():
+        start_time = time.time()
+        for _ in range(repeat):
+            legacy = [legacy_normalize(content) for content in contents]
+        legacy_cost = time.time() - start_time
+        start_time = time.time()
+        for _ in range(repeat):
+            blocks = [splitter.url_splitter(splitter.filter(content)) for content in contents]
+        cost = time.time() - start_time
+        same = legacy == [[(block.to_string(), block.integrity) for block in item] for item in blocks]
+        result[name] = (legacy_cost, cost, same)
+        print("[{}] {} input(s), {:.1f} KB: legacy {:.3f}s, precompiled {:.3f}s, speedup {:.2f}x, same output: {}".format(
+            name, len(contents), sum([len(i) for i in contents]) / 1024, legacy_cost, cost,
+            legacy_cost / cost if cost > 0 else float("inf"), same))
+    return result
+
+if __name__ == "__main__":
+    bench_load(["./南哪QA.qa"])
+    # bench_cache(["./南哪QA.qa"])
+    # bench_startup("QA")
+    # bench_index("QA")
+    # bench_codec("QA")
+    # bench_search_many("QA")
+    # bench_qa_layout()
+    # bench_dispatcher()
+    # bench_bucketing()
+    # bench_length_mode()
+    # bench_streaming()
+    # bench_normalize()
+    # bench_backend(num_threads=os.cpu_count())
+    # bench_pipeline(["./南哪QA.qa"] + ["./data/" + i for i in os.listdir("./data/") if os.path.isfile("./data/" + i)])
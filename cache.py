@@ -0,0 +1,175 @@
+import re
+import time
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+
+"""
+    嵌入向量缓存
+"""
+
+class EmbeddingCache:
+    """
+        以 (文本哈希, 模型, 序列长度) 为键，将嵌入向量持久化在 sqlite 数据库中
+        重建向量库时，已经计算过的文本块可以直接从磁盘读取向量，无需再次调用嵌入模型
+    """
+    path: str
+    model_id: str
+    sequence_length: int
+    max_size: int
+    hits, misses = 0, 0
+    conn = None
+
+    def __init__(self, path:str, model_id:str, sequence_length:int, max_size:int=1024*1024*1024):
+        """
+            path: 缓存数据库路径
+            model_id: 嵌入模型名称
+            sequence_length: 嵌入模型的序列长度
+            max_size: 缓存向量的最大总字节数，超出后按最近访问时间淘汰
+        """
+        self.path, self.model_id = path, model_id
+        self.sequence_length, self.max_size = sequence_length, max_size
+        self.hits, self.misses = 0, 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            "hash TEXT, model TEXT, length INTEGER, vector BLOB, size INTEGER, access REAL, "
+            "PRIMARY KEY (hash, model, length))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS vectors_access ON vectors (access)")
+        self.conn.commit()
+
+    def __len__(self) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM vectors WHERE model = ? AND length = ?",
+            (self.model_id, self.sequence_length)
+        ).fetchone()[0]
+
+    def get_many(self, hashes:list) -> dict:
+        """
+            批量读取向量
+
+            返回：命中的 {哈希: 向量} 字典
+        """
+        result, now = {}, time.time()
+        for i in range(0, len(hashes), 500):
+            part = hashes[i : i+500]
+            marks = ",".join(["?"] * len(part))
+            rows = self.conn.execute(
+                "SELECT hash, vector FROM vectors WHERE model = ? AND length = ? AND hash IN ({})".format(marks),
+                [self.model_id, self.sequence_length] + part
+            ).fetchall()
+            for hash_id, blob in rows:
+                result[hash_id] = array("f", blob).tolist()
+            self.conn.execute(
+                "UPDATE vectors SET access = ? WHERE model = ? AND length = ? AND hash IN ({})".format(marks),
+                [now, self.model_id, self.sequence_length] + part
+            )
+        self.conn.commit()
+        self.hits += len(result)
+        self.misses += len(set(hashes)) - len(result)
+        return result
+
+    def put_many(self, hashes:list, vectors:list):
+        """
+            批量写入向量，写入后按需淘汰旧的向量
+        """
+        now = time.time()
+        rows = []
+        for hash_id, vector in zip(hashes, vectors):
+            blob = array("f", vector).tobytes()
+            rows.append((hash_id, self.model_id, self.sequence_length, blob, len(blob), now))
+        self.conn.executemany("INSERT OR REPLACE INTO vectors VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        """
+            删除最久未访问的向量，直到总大小不超过 max_size
+        """
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM vectors").fetchone()[0]
+        if total <= self.max_size:
+            return
+        removed = []
+        for rowid, size in self.conn.execute("SELECT rowid, size FROM vectors ORDER BY access"):
+            if total <= self.max_size:
+                break
+            total -= size
+            removed.append((rowid,))
+        self.conn.executemany("DELETE FROM vectors WHERE rowid = ?", removed)
+        self.conn.commit()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+class QueryCache:
+    """
+        查询向量的内存 LRU 缓存，可选过期时间
+        以 (嵌入模型, 规范化后的查询文本) 为键，嵌入模型改变时原有的缓存自然失效
+    """
+    max_size: int = 1024
+    ttl: float = None
+    hits, misses = 0, 0
+    items = None
+    lock = None
+
+    def __init__(self, max_size:int=1024, ttl:float=None):
+        """
+            max_size: 最多缓存的查询数量
+            ttl: 缓存的有效时间（秒），为 None 时不过期
+        """
+        self.max_size, self.ttl = max_size, ttl
+        self.hits, self.misses = 0, 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    @staticmethod
+    def normalize(text:str) -> str:
+        return re.sub(r"\s+", " ", text).strip()
+
+    def get(self, model_key, text:str):
+        """
+            读取缓存的向量，未命中或已过期时返回 None
+        """
+        key = (model_key, self.normalize(text))
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and self.ttl is not None and time.time() - item[1] > self.ttl:
+                del self.items[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, model_key, text:str, vector:list):
+        key = (model_key, self.normalize(text))
+        with self.lock:
+            self.items[key] = (vector, time.time())
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def invalidate(self, model_key=None):
+        """
+            删除某个嵌入模型的缓存，model_key 为 None 时清空所有缓存
+        """
+        with self.lock:
+            if model_key is None:
+                self.items.clear()
+            else:
+                for key in [key for key in self.items if key[0] == model_key]:
+                    del self.items[key]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits, "misses": self.misses, "size": len(self),
+            "hit_rate": self.hits / total if total > 0 else 0.0
+        }
@@ -2,7 +2,10 @@ import os
 import re
 import time
 import json
-from typing import Literal
+import hashlib
+from array import array
+from bisect import bisect_left
+from typing import Iterator
 from langchain_core.documents import Document
 from langchain_community.document_loaders.base import BaseLoader
 from langchain.document_loaders import TextLoader, BSHTMLLoader, PyPDFLoader, Docx2txtLoader, CSVLoader
@@ -12,113 +15,179 @@ from langchain.document_loaders import TextLoader, BSHTMLLoader, PyPDFLoader, Do
     pip install pypdf docx2txt bs4
 """
 
+class TokenCounter:
+    """
+        使用嵌入模型的分词器计算文本长度（token 数，不含 [CLS]、[SEP]）
+        结果按文本缓存每个 token 的起始字符位置，未缓存的文本一次批量分词
+    """
+    counters: dict = {}
+    tokenizer = None
+    cache: dict = {}
+    max_cache: int = 100000
+
+    def __init__(self, tokenizer, max_cache:int=100000):
+        """
+            tokenizer: transformers 的快速分词器，需要支持 return_offsets_mapping
+            max_cache: 最多缓存的文本数量，超出后清空
+        """
+        self.tokenizer, self.max_cache = tokenizer, max_cache
+        self.cache = {}
+
+    @staticmethod
+    def get(model_dir:str) -> "TokenCounter":
+        """
+            取得模型目录对应的 TokenCounter，每个进程中只加载一次分词器
+        """
+        if model_dir not in TokenCounter.counters:
+            try:
+                from transformers import AutoTokenizer
+            except ImportError as e:
+                raise ImportError("按 token 划分文本需要安装 transformers：pip install transformers") from e
+            TokenCounter.counters[model_dir] = TokenCounter(AutoTokenizer.from_pretrained(model_dir, use_fast=True))
+        return TokenCounter.counters[model_dir]
+
+    def starts_many(self, texts:list[str]) -> list[array]:
+        """
+            返回：每个文本中各个 token 的起始字符位置
+        """
+        missing = list({text for text in texts if text not in self.cache})
+        if len(missing) > 0:
+            if len(self.cache) + len(missing) > self.max_cache:
+                self.cache = {}
+            encoded = self.tokenizer(
+                missing, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+            self.cache.update(zip(missing, [array("l", [i[0] for i in offsets]) for offsets in encoded]))
+        return [self.cache[text] for text in texts]
+
+    def count_many(self, texts:list[str]) -> list[int]:
+        return [len(i) for i in self.starts_many(texts)]
+
+    def count(self, text:str) -> int:
+        return self.count_many([text])[0]
+
 class ContentBlock:
-    size: int = 0
-    content: list[(str, int, bool)] = []
-    type: Literal["ContentBlock"] = "ContentBlock"
+    """
+        源字符串 source 中的一个片段 [start, end)，同一文档的所有片段共享同一个源字符串
+    """
+    __slots__ = ("source", "start", "end", "integrity")
 
-    def __init__(self, content:str="", integrity:bool=False):
+    def __init__(self, source:str="", integrity:bool=False, start:int=0, end:int=None):
         """
-            content: 内容
-            integrity: 是否允许拆分
+            source: 源字符串
+            integrity: 是否不允许拆分
+            start, end: 片段在源字符串中的位置，end 为 None 时到源字符串末尾
         """
-        self.size = 0
-        self.content = []
-        if content != "":
-            self.append_content(content, len(content), integrity)
-    
+        self.source, self.integrity = source, integrity
+        self.start, self.end = start, len(source) if end is None else end
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+
     def __str__(self) -> str:
-        return f"[size: {self.size}] "+self.content.__str__()
+        return f"[{self.start}, {self.end}) "+self.to_string().__repr__()
 
     def to_string(self) -> str:
-        return "".join([i[0] for i in self.content])
-
-    def append_content(
-        self,
-        content: str,
-        size: int,
-        integrity: bool=False
-    ) -> None:
-        self.content.append((content, size, integrity))
-        self.size += size
-    
-    def merge_block(
-        self,
-        item: Literal["ContentBlock"]
-    ):
-        """
-            合并两个 ContentBlock 对象，将 item 的内容加入到 self 后面
-        """
-        self.content += item.content
-        self.size += item.size
-
-    def append_block(
-        self,
-        item: Literal["ContentBlock"],
-        block_size: int
-    ) -> Literal["ContentBlock"]:
-        """
-            在内容后追加字符串，限制最大长度为 block_size
-
-            返回：剩余的文本构成的 ContentBlock
-            注意：
-                如果 item 被完全加入，rest 为 None
-                如果恰好分割到的文本块的 integrity 为 True，且长度不够完整加入，将会选择不加入这个文本块
-        """
-        if self.size + item.size <= block_size:
-            self.content += item.content
-            self.size += item.size
-            return None
-        else:
-            accept, rest, full = ContentBlock(), ContentBlock(), False
-            for it in item.content:
-                if full:
-                    # 此块已满，不加入
-                    rest.append_content(it[0], it[1], it[2])
-                else:
-                    if self.size + it[1] <= block_size:
-                        accept.append_content(it[0], it[1], it[2])
-                    else:
-                        full = True
-                        if it[2]:
-                            # 此块不可拆分，故不加入
-                            rest.append_content(it[0], it[1], it[2])
-                        else:
-                            # 此块可拆分，拆分一部分加入
-                            split_size = block_size - self.size
-                            accept.append_content(it[0][0 : split_size], split_size, False)
-                            rest.append_content(it[0][split_size : ], it[1] - split_size, False)
-            self.merge_block(accept)
-            return rest
-
-    def append_keep_block(
-        self,
-        item: Literal["ContentBlock"],
-        block_size: int
-    ):
-        '''
-            通过删除靠前的内容，保持文本总长度不大于 block_size 大小
-        '''
-        self.merge_block(item)
-        if self.size <= block_size:
-            return 
-        else:
-            while self.size - self.content[0][1] > block_size:
-                self.size -= self.content[0][1]
-                self.content.pop(0)
-            if self.content[0][2]:
-                # 不可拆分的文本块，直接整块删除
-                self.size -= self.content[0][1]
-                self.content.pop(0)
-            else:
-                # 可拆分的文本块，删除前一部分，保持总长度不大于 block_size
-                remove_size = self.size - block_size
-                self.size = block_size
-                self.content[0] = (self.content[0][0][remove_size : ], self.content[0][1] - remove_size, False)
+        return self.source[self.start : self.end]
+
+class ContentSpans:
+    """
+        一个文档的全部片段：片段的起始位置、是否不可拆分分别保存在紧凑数组中
+        划分只移动源字符串上的偏移量，每个文本块只在输出时切片一次
+
+        长度单位：没有 counter 时为字符，位置即长度；
+            否则为 token，units 保存源字符串中每个 token 的起始位置，
+            一段文本的长度为其中 token 起始位置的个数
+    """
+    __slots__ = ("source", "starts", "integrity", "units")
+
+    def __init__(self, blocks:list[ContentBlock], counter:TokenCounter=None):
+        """
+            blocks: 共享同一个源字符串、首尾相接的片段，见 TextSplitter.url_splitter
+        """
+        self.source = blocks[0].source if len(blocks) > 0 else ""
+        self.starts = array("l", [block.start for block in blocks])
+        self.starts.append(blocks[-1].end if len(blocks) > 0 else 0)
+        self.integrity = bytes([block.integrity for block in blocks])
+        self.units = None
+        if counter is not None:
+            self.units = array("l")
+            for block, starts in zip(blocks, counter.starts_many([block.to_string() for block in blocks])):
+                self.units.extend([block.start + i for i in starts])
+
+    def size(self, start:int, end:int) -> int:
+        if self.units is None:
+            return end - start
+        return bisect_left(self.units, end) - bisect_left(self.units, start)
+
+    def advance(self, start:int, size:int) -> int:
+        """
+            返回：从 start 开始，长度为 size 的文本的结束位置，调用者保证剩余文本足够长
+        """
+        if self.units is None:
+            return start + size
+        return self.units[bisect_left(self.units, start) + size]
+
+    def retreat(self, end:int, size:int) -> int:
+        """
+            返回：到 end 结束，长度为 size 的文本的起始位置，调用者保证前面的文本足够长
+        """
+        if self.units is None:
+            return end - size
+        return self.units[bisect_left(self.units, end) - size]
+
+def iter_json_array(file_input, chunk_size:int=64*1024) -> Iterator:
+    """
+        逐个给出文件中 JSON 数组的元素，每次读入 chunk_size 个字符，
+        内存中只有当前元素和尚未解析的文本
+    """
+    decoder, whitespace = json.JSONDecoder(), re.compile(r"[ \t\n\r]*")
+    buffer, position, state, eof, size = "", 0, "start", False, chunk_size
+    while True:
+        position = whitespace.match(buffer, position).end()
+        if position < len(buffer):
+            char = buffer[position]
+            if state == "start":
+                if char != "[":
+                    raise json.JSONDecodeError("Expecting '['", buffer, position)
+                position, state = position + 1, "first"
+                continue
+            if state == "after" or (state == "first" and char == "]"):
+                if char == "]":
+                    return
+                if char != ",":
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, position)
+                position, state = position + 1, "value"
+                continue
+            try:
+                item, item_end = decoder.raw_decode(buffer, position)
+                # 看到元素后面的分隔符才能确定元素已经读完（如数字 -25 可能是 -2500.0 的一部分）
+                delimiter = whitespace.match(buffer, item_end).end()
+                if eof or (delimiter < len(buffer) and buffer[delimiter] in ",]"):
+                    yield item
+                    position, state, size = item_end, "after", chunk_size
+                    continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+        elif eof:
+            raise json.JSONDecodeError("Unterminated array", buffer, position)
+        # 读入更多文本，一个元素很长时每次读入的长度加倍，避免反复解析
+        text = file_input.read(size)
+        buffer, position, eof, size = buffer[position : ] + text, 0, text == "", size * 2
+
+def iter_json_lines(file_input) -> Iterator:
+    """
+        逐行给出 JSONL 文件中的对象，跳过空行
+    """
+    for line in file_input:
+        if line.strip() != "":
+            yield json.loads(line)
 
 class QAJsonLoader(BaseLoader):
     """
         转换用于 Qwen 微调的 json 格式 QA 对数据
+        文件可以是 JSON 数组，也可以是每行一条记录的 JSONL，记录逐条读入，不需要把整个文件解析到内存中
     """
 
     docs = []
@@ -134,41 +203,95 @@ class QAJsonLoader(BaseLoader):
             return Document(page_content=content, metadata={"source": self.file_path})
         except Exception as e:
             raise RuntimeError(f"Error loading {self.file_path}") from e
-    
+
+    def iter_records(self) -> Iterator[dict]:
+        """
+            逐条给出 QA 记录，以第一个非空白字符判断文件是 JSON 数组还是 JSONL
+        """
+        with open(self.file_path, "r", encoding=self.encoding) as file_input:
+            char = file_input.read(1)
+            while char != "" and char.isspace():
+                char = file_input.read(1)
+            file_input.seek(0)
+            if char == "[":
+                yield from iter_json_array(file_input)
+            else:
+                yield from iter_json_lines(file_input)
+
+    def split_record(self, qa:dict, page:int, block_size:int, cover_size:int, text_splitter) -> list[Document]:
+        """
+            以“问题$answer$答案”的形式划分一条 QA 记录，答案的块大小要减去问题的长度
+            块大小只作为参数传给 content_splitter，不修改 text_splitter，可以同时划分多条记录
+        """
+        question = text_splitter.filter(qa["conversations"][0]["value"])
+        answer = text_splitter.filter(qa["conversations"][1]["value"])
+        docs = text_splitter.content_splitter(
+            doc = answer, metadata = {"source": self.file_path, "page": page},
+            block_size = block_size - text_splitter.length(question) - 10, cover_size = cover_size
+        )
+        for doc in docs:
+            doc.page_content = question + '$answer$' + doc.page_content
+        return docs
+
+    def lazy_split(self, block_size, cover_size, text_splitter) -> Iterator[Document]:
+        for page, qa in enumerate(self.iter_records()):
+            yield from self.split_record(qa, page+1, block_size, cover_size, text_splitter)
+
     def load_and_split(self, block_size, cover_size, text_splitter):
-        self.docs = []
-        qa_list = json.load(
-            open(self.file_path, "r", encoding=self.encoding))
-        
-        for page in range(len(qa_list)):
-            qa = qa_list[page]
-            self.Q = text_splitter.filter(qa["conversations"][0]["value"])
-            page_size = block_size - len(self.Q) - 10
-            text_splitter.block_size = page_size
-            text_splitter.cover_size = cover_size
-            self.A = text_splitter.filter(qa["conversations"][1]["value"])
-            self.A = text_splitter.content_splitter(
-                doc = self.A, metadata = {"source": self.file_path, "page": page+1}
+        self.docs = list(self.lazy_split(block_size, cover_size, text_splitter))
+        return self.docs
+
+    def lazy_questions(self, text_splitter) -> Iterator[Document]:
+        for page, qa in enumerate(self.iter_records()):
+            question = text_splitter.filter(qa["conversations"][0]["value"])
+            answer = text_splitter.filter(qa["conversations"][1]["value"])
+            yield Document(
+                page_content = question,
+                metadata = {
+                    "source": self.file_path, "page": page+1,
+                    "answer_id": hashlib.md5(answer.encode()).hexdigest(),
+                    "answer": answer
+                }
             )
-            for doc in self.A:
-                doc.page_content = self.Q + '$answer$' + doc.page_content
-                self.docs.append(doc)
 
+    def load_questions(self, text_splitter):
+        """
+            只以问题作为文档内容，答案放在 metadata 的 answer 字段中，
+            并以答案的 md5 值作为 answer_id，相同的答案只需要保存一次
+        """
+        self.docs = list(self.lazy_questions(text_splitter))
         return self.docs
 
 class TextSplitter:
     index = False
     block_size = 512
     cover_size = 128
+    counter = None
+    # 预编译的正则表达式，见 invisible_filter、split_urls
+    space_pattern = re.compile(r"[\t\f\v\r \xa0]+")
+    newline_pattern = re.compile(r"[\n]+")
+    # 原来的写法是逐个字符的多选一：[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|%[0-9a-fA-F][0-9a-fA-F]，
+    # % 本身在 $-_ 的范围内，合并成一个字符集后匹配的内容相同，速度更快
+    url_pattern = re.compile(r"(http[s]?://[a-zA-Z0-9$-_@.&+!*\\(),%]+)")
+    # 可能出现在链接中的字符，与 url_pattern 一致
+    url_char = re.compile(r"[a-zA-Z0-9$-_@.&+!*\\(),%]")
 
-    def __init__(self, block_size, cover_size, index=False):
+    def __init__(self, block_size, cover_size, index=False, counter:TokenCounter=None):
+        """
+            counter: 为 None 时 block_size、cover_size 以字符数计算，
+                否则以 counter 给出的 token 数计算，见 TokenCounter
+        """
         self.index = index
         self.block_size = block_size
         self.cover_size = cover_size
+        self.counter = counter
+
+    def length(self, content:str) -> int:
+        return self.counter.count(content) if self.counter is not None else len(content)
     
     def invisible_filter(self, content:str) -> str:
-        content = re.sub(r"[\t\f\v\r \xa0]+", " ", content)
-        content = re.sub(r"[\n]+", "\n", content)
+        content = self.space_pattern.sub(" ", content)
+        content = self.newline_pattern.sub("\n", content)
         return content
     
     def tag_filter(self, content:str) -> str:
@@ -183,73 +306,206 @@ class TextSplitter:
         content = self.tag_filter(content)
         return content
     
+    def split_urls(self, doc:str) -> list[str]:
+        """
+            以链接划分字符串，一次 split 得到“文本、链接、文本……”交替的列表
+            文本中有 $ 时，仍先插入 $url$ 标记再划分，使文本中原有的 $url$ 也作为分隔，与原来的结果相同
+        """
+        if "$" in doc:
+            return self.url_pattern.sub(r"$url$\1$url$", doc).split("$url$")
+        return self.url_pattern.split(doc)
+
     def url_splitter(self, doc:str) -> list[ContentBlock]:
         """
-            以链接划分字符串
+            以链接划分字符串，所有片段共享去除空白后拼接成的同一个源字符串
         """
-        url_pattern = r"(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)"
-        doc = re.sub(url_pattern, r"$url$\1$url$", doc)
-        docs = [i.strip() for i in doc.split("$url$")]
-        docs = [ContentBlock(i, i[0:4] == "http") for i in docs]
-        return docs
+        pieces = [i.strip() for i in self.split_urls(doc)]
+        source, blocks, start = "".join(pieces), [], 0
+        for piece in pieces:
+            blocks.append(ContentBlock(source, piece[0:4] == "http", start, start + len(piece)))
+            start += len(piece)
+        return blocks
 
-    def content_splitter(self, doc:str, metadata:dict) -> list[Document]:
+    def safe_cut(self, text:str) -> int:
+        """
+            返回：text 中最后一个安全切分点的位置，没有时返回 0，见 stream_blocks
+        """
+        for i in range(len(text) - 1, 0, -1):
+            if not text[i-1].isspace() and (text[i].isspace() or self.url_char.match(text[i-1]) is None):
+                return i
+        return 0
+
+    def stream_blocks(self, windows) -> Iterator[list[ContentBlock]]:
+        """
+            以流的方式过滤文本并以链接划分，windows 为依次读入的原始文本
+            每次只处理到最后一个安全的切分点：切分点之前是非空白字符，之后是空白字符或之前的字符不会出现在链接中，
+            空白字符的合并、链接的识别都不会跨过切分点，结果与对整个文本调用 filter 和 url_splitter 相同
+
+            返回：每次处理得到的一组片段，同一组片段共享同一个源字符串
+        """
+        buffer, head, windows = "", True, iter(windows)
+        # 跨过切分点、不可拆分的片段留到下一次，与后面的部分合并成一个片段
+        pending, integral = "", False
+        while True:
+            window = next(windows, None)
+            if window is None:
+                text, buffer = buffer, ""
+            else:
+                buffer += window
+                cut = self.safe_cut(buffer)
+                if cut == 0:
+                    continue
+                text, buffer = buffer[0 : cut], buffer[cut : ]
+            text = self.tag_filter(self.invisible_filter(text))
+            parts = self.split_urls(text)
+            pieces = []
+            for i, part in enumerate(parts):
+                # 除第一段外，每段都是一个新片段的开头；最后一段可能在下一次处理的文本中继续
+                if i == 0:
+                    part, pending = pending + part, ""
+                head = head or i > 0
+                integral = integral and i == 0
+                if head:
+                    part = part.lstrip()
+                    head, integral = part == "", part[0:4] == "http"
+                if i < len(parts) - 1 or window is None:
+                    part = part.rstrip()
+                elif integral:
+                    pending = part
+                    continue
+                pieces.append((part, integral))
+            source, blocks, start = "".join([part for part, _ in pieces]), [], 0
+            for part, integrity in pieces:
+                blocks.append(ContentBlock(source, integrity, start, start + len(part)))
+                start += len(part)
+            yield blocks
+            if window is None:
+                return
+
+    def content_splitter(self, doc:str, metadata:dict, block_size:int=None, cover_size:int=None) -> list[Document]:
         """
             对内容划分，遵循 block_size 和 cover_size
             期望最大程度上保持链接完整
+            block_size, cover_size: 只用于这次划分，为 None 时使用 self.block_size、self.cover_size
 
             返回：划分后的 Document 列表
         """
-        docs, index_count = [], 0
-        blocks = self.url_splitter(doc)
-        last, this = ContentBlock(), ContentBlock()
-        for block in blocks:
-            result = this.append_block(block, self.block_size-self.cover_size)
-            while result is not None:
-                if self.index:
-                    index_count += 1
-                    metadata.update({"index": index_count})
-                docs.append(Document(
-                    page_content = last.to_string()+this.to_string(),
-                    metadata = dict(metadata)
-                ))
-                last.append_keep_block(this, self.cover_size)
-                this = ContentBlock()
-                result = this.append_block(result, self.block_size-self.cover_size)
-        if this is not None and this.size > 0:
+        return list(self.iter_content([self.url_splitter(doc)], metadata, block_size, cover_size))
+
+    def iter_content(self, groups, metadata:dict, block_size:int=None, cover_size:int=None) -> Iterator[Document]:
+        """
+            以生成器的方式划分内容，groups 为依次给出的若干组片段，见 url_splitter、stream_blocks
+            上一组中仍在覆盖范围内的内容会与下一组拼接，结果与把所有片段放在一起划分相同
+
+            每个文本块由两部分组成：上一块末尾不超过 cover_size 的覆盖部分 [last, this)，
+            以及不超过 block_size - cover_size 的新内容 [this, end)
+            新内容放不下一个不可拆分的片段时，在片段之前结束；可拆分的片段则拆分一部分加入
+            覆盖部分的起点落在不可拆分的片段中间时，整个片段都不保留
+        """
+        index_count = 0
+        block_size = self.block_size if block_size is None else block_size
+        cover_size = self.cover_size if cover_size is None else cover_size
+        # block_size 不大于 cover_size 时每块至少加入一个单位的新内容，保证划分能够结束
+        limit = max(block_size - cover_size, 1)
+        blocks, first, last, this, end = [], 0, 0, 0, 0
+        for group in groups:
+            if len(blocks) > 0:
+                # 只保留上一组中 last 之后的内容，位置改为相对于新的源字符串
+                head = blocks[0].source[last : ]
+                carry = [block for block in blocks if block.end > last]
+                source = head + (group[0].source if len(group) > 0 else "")
+                blocks = [
+                    ContentBlock(source, block.integrity, max(block.start, last) - last, block.end - last)
+                    for block in carry
+                ] + [
+                    ContentBlock(source, block.integrity, block.start + len(head), block.end + len(head))
+                    for block in group
+                ]
+                first, last, this, end = len(carry), 0, this - last, end - last
+            else:
+                blocks, first = group, 0
+            spans = ContentSpans(blocks, self.counter)
+            source, starts, integrity, piece = spans.source, spans.starts, spans.integrity, 0
+            for k in range(first, len(integrity)):
+                item_end = starts[k+1]
+                while True:
+                    used = spans.size(this, end)
+                    if used + spans.size(end, item_end) <= limit:
+                        end = item_end
+                        break
+                    if not integrity[k] or used == 0:
+                        # 可拆分的片段拆分一部分加入，不可拆分的片段比整块还长时也只能拆分
+                        end = spans.advance(end, limit - used)
+                    if self.index:
+                        index_count += 1
+                        metadata.update({"index": index_count})
+                    yield Document(
+                        page_content = source[last : end],
+                        metadata = dict(metadata)
+                    )
+                    if spans.size(last, end) > cover_size:
+                        last = spans.retreat(end, cover_size)
+                        while piece + 1 < len(integrity) and starts[piece+1] <= last:
+                            piece += 1
+                        if integrity[piece] and starts[piece] < last:
+                            # 不可拆分的片段，直接整块删除
+                            last = starts[piece+1]
+                    this = end
+        if len(blocks) > 0 and spans.size(this, end) > 0:
             if self.index:
                 index_count += 1
                 metadata.update({"index": index_count})
-            docs.append(Document(
-                page_content = last.to_string()+this.to_string(),
+            yield Document(
+                page_content = spans.source[last : end],
                 metadata = dict(metadata)
-            ))
-        return docs
+            )
 
-    def split_documents(self, docs:list[Document]) -> list[Document]:
+    def iter_documents(self, docs) -> Iterator[Document]:
         """
-            对文档列表进行划分
+            以生成器的方式对文档逐个划分，docs 也可以是生成器
         """
-        temp = []
         for doc in docs:
-            temp += self.content_splitter(
+            yield from self.content_splitter(
                 doc = self.filter(doc.page_content),
                 metadata = doc.metadata
             )
-        return temp
+
+    def split_documents(self, docs:list[Document]) -> list[Document]:
+        """
+            对文档列表进行划分
+        """
+        return list(self.iter_documents(docs))
+
+def read_windows(path:str, encoding:str="utf-8", window:int=1024*1024) -> Iterator[str]:
+    """
+        每次读入文件中的 window 个字符
+    """
+    with open(path, "r", encoding=encoding) as file_input:
+        while True:
+            text = file_input.read(window)
+            if text == "":
+                return
+            yield text
 
 supported_types = ["txt", "html", "htm", "md",
                    "pdf", "doc", "docx",
                    "xls", "xlsx", "csv",
                    "qa" # 转换用于 Qwen 微调 json 格式的 QA 对
                    ]
-def LoadFile(path, size=512, cover=128, type="auto", index=False, encoding="utf-8") -> list[Document]:
+def LoadFile(
+    path, size=512, cover=128, type="auto", index=False, encoding="utf-8", qa_layout="chunk", tokenizer=None
+) -> list[Document]:
     """
         path: 文件路径
         type: 文件类型
         encoding: 文件编码
         index: 是否对某个文档的若干划分进行编号，
             编号从 1 开始，会在 metadata 中添加 index 字段
+        qa_layout: qa 文件的划分方式
+            chunk: 以“问题$answer$答案”的形式划分
+            question: 只以问题作为文档内容，答案放在 metadata 中，见 QAJsonLoader.load_questions
+        tokenizer: 嵌入模型的目录，给出时 size、cover 以该模型分词后的 token 数计算，
+            并为 [CLS]、[SEP] 预留 2 个 token，使文本块恰好填满模型的序列长度而不被截断
 
         为给定文件分配对应的文件加载器，并加载、划分文档
         返回：加载并划分完成，生成的文档列表
@@ -258,31 +514,72 @@ def LoadFile(path, size=512, cover=128, type="auto", index=False, encoding="utf-
     if type == "auto":
         suffix = os.path.splitext(path)[1].lower().replace(".", "")
         type = suffix if suffix in supported_types else "txt"
+    counter = None
+    if tokenizer is not None:
+        counter, size = TokenCounter.get(tokenizer), size - 2
     
     if type == "txt":
         return TextLoader(file_path=path, encoding=encoding). \
-            load_and_split(text_splitter=TextSplitter(size, cover, index))
+            load_and_split(text_splitter=TextSplitter(size, cover, index, counter))
     elif type == "html" or type == "htm":
         return BSHTMLLoader(file_path=path, open_encoding=encoding). \
-            load_and_split(text_splitter=TextSplitter(size, cover, index))
+            load_and_split(text_splitter=TextSplitter(size, cover, index, counter))
     elif type == "md":
         return TextLoader(file_path=path, encoding="utf-8"). \
-            load_and_split(text_splitter=TextSplitter(size, cover, index))
+            load_and_split(text_splitter=TextSplitter(size, cover, index, counter))
     elif type == "pdf":
         return PyPDFLoader(file_path=path). \
-            load_and_split(text_splitter=TextSplitter(size, cover, index))
+            load_and_split(text_splitter=TextSplitter(size, cover, index, counter))
     elif type == "doc" or type == "docx":
         return Docx2txtLoader(file_path=path). \
-            load_and_split(text_splitter=TextSplitter(size, cover, index))
+            load_and_split(text_splitter=TextSplitter(size, cover, index, counter))
+    elif type == "qa" and qa_layout == "question":
+        return QAJsonLoader(file_path=path, encoding=encoding). \
+            load_questions(text_splitter=TextSplitter(size, cover, index, counter))
     elif type == "qa":
         return QAJsonLoader(file_path=path, encoding=encoding). \
             load_and_split(block_size=size, cover_size=cover, \
-                           text_splitter=TextSplitter(size, cover, index))
+                           text_splitter=TextSplitter(size, cover, index, counter))
     elif type == "csv":
         return CSVLoader(file_path=path, encoding=encoding).load()
     else:
         raise ValueError("Unsupported file type: {}".format(type))
 
+def iter_load_file(
+    path, size=512, cover=128, type="auto", index=False, encoding="utf-8", qa_layout="chunk", tokenizer=None,
+    window=1024*1024
+) -> Iterator[Document]:
+    """
+        参数与 LoadFile 相同，以生成器的方式逐个给出划分后的文档，结果与 LoadFile 相同
+        window: txt、md 文件每次读入的字符数，同一时间只有一个窗口和上一块的覆盖部分在内存中，
+            内存占用不随文件大小增长
+        qa 文件逐条读入记录，pdf 文件逐页读入；其它类型的文件整个读入后再逐个划分
+    """
+    if type == "auto":
+        suffix = os.path.splitext(path)[1].lower().replace(".", "")
+        type = suffix if suffix in supported_types else "txt"
+    if type not in ("txt", "md", "pdf", "html", "htm", "doc", "docx", "qa"):
+        yield from LoadFile(path, size, cover, type, index, encoding, qa_layout, tokenizer)
+        return
+    counter = None
+    if tokenizer is not None:
+        counter, size = TokenCounter.get(tokenizer), size - 2
+    text_splitter = TextSplitter(size, cover, index, counter)
+
+    if type == "txt" or type == "md":
+        windows = read_windows(path, encoding if type == "txt" else "utf-8", window)
+        yield from text_splitter.iter_content(text_splitter.stream_blocks(windows), {"source": path})
+    elif type == "qa" and qa_layout == "question":
+        yield from QAJsonLoader(file_path=path, encoding=encoding).lazy_questions(text_splitter)
+    elif type == "qa":
+        yield from QAJsonLoader(file_path=path, encoding=encoding).lazy_split(size, cover, text_splitter)
+    elif type == "pdf":
+        yield from text_splitter.iter_documents(PyPDFLoader(file_path=path).lazy_load())
+    elif type == "html" or type == "htm":
+        yield from text_splitter.iter_documents(BSHTMLLoader(file_path=path, open_encoding=encoding).load())
+    else:
+        yield from text_splitter.iter_documents(Docx2txtLoader(file_path=path).load())
+
 if __name__ == "__main__":
     loader = LoadFile("./data/example.json", 512, 128, "QA")
     # loader = LoadFile("./data/选课.csv", 512, 128, "auto", True)
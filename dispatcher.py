@@ -0,0 +1,99 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+"""
+    查询嵌入的动态批处理
+"""
+
+class EmbeddingDispatcher:
+    """
+        把多个线程并发提交的查询合并为一次 embed_documents 调用
+        第一个查询到达后，最多再等待 window 秒，或凑够 max_batch 个文本，然后一起嵌入，
+        每个调用者得到自己的向量
+        并发时 N 个查询只需要一次前向计算，代价是每个查询最多增加 window 秒的延迟
+    """
+    model = None
+    window: float = 0.005
+    max_batch: int = 32
+    requests = None
+    worker = None
+    lock = None
+    batches, items = 0, 0
+
+    def __init__(self, model, window:float=0.005, max_batch:int=32):
+        """
+            model: 嵌入模型，需要有 embed_documents 方法
+            window: 凑批的最长等待时间（秒）
+            max_batch: 一批最多包含的文本数量
+        """
+        self.model, self.window, self.max_batch = model, window, max_batch
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+        self.batches, self.items = 0, 0
+
+    def embed(self, texts:list) -> list:
+        """
+            计算一组文本的嵌入向量，会阻塞到这组文本所在的批次完成
+        """
+        if len(texts) == 0:
+            return []
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+        future = Future()
+        self.requests.put((texts, future))
+        return future.result()
+
+    def embed_query(self, text:str) -> list:
+        return self.embed([text])[0]
+
+    def collect(self) -> list:
+        """
+            取出一批请求：阻塞等待第一个请求，之后在 window 秒内继续收集
+            已经有积压的请求时不再等待
+        """
+        batch = [self.requests.get()]
+        count = len(batch[0][0])
+        # 上一批计算期间积压的请求已经等待过，直接取出，不再等待
+        while count < self.max_batch and not self.requests.empty():
+            batch.append(self.requests.get_nowait())
+            count += len(batch[-1][0])
+        deadline = time.time() + (self.window if len(batch) == 1 else 0)
+        while count < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            count += len(item[0])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            texts = [text for item in batch for text in item[0]]
+            try:
+                vectors = self.model.embed_documents(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(texts)
+            offset = 0
+            for part, future in batch:
+                future.set_result(vectors[offset : offset+len(part)])
+                offset += len(part)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches, "items": self.items,
+            "average_batch": self.items / self.batches if self.batches > 0 else 0.0
+        }
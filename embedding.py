@@ -1,14 +1,24 @@
 import re
 import os
 import json
+import time
 import hashlib
+from collections import Counter
+
+import faiss
+import numpy as np
 
 from adjustment.embeddings import ModelScopeEmbeddings
 
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, SystemMessagePromptTemplate
 from langchain.chains import LLMChain
 
-from data import LoadFile
+from data import LoadFile, iter_load_file
+from cache import EmbeddingCache, QueryCache
+from lexical import NGramIndex, reciprocal_rank_fusion
+from store import SegmentStore, AnswerStore, index_config, create_index, tune_index, store_kwargs, train_size, is_staging, search_params
+from ingest import IngestPipeline
+from dispatcher import EmbeddingDispatcher
 
 # 如果预处理需要的话，可以使用大语言模型
 # from langchain.chat_models import ChatOpenAI
@@ -22,6 +32,66 @@ from data import LoadFile
 
 # 引入 FAISS 向量库进行文档存储和搜索
 from langchain_community.vectorstores.faiss import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+
+def maximal_marginal_relevance(query, candidates, k:int=5, lambda_mult:float=0.5) -> list:
+    """
+        最大边际相关性：在与查询相关的同时，尽量选择与已选文档不相似的文档
+        query: 查询向量
+        candidates: 候选向量矩阵，每行一个向量
+        lambda_mult: 相关性的权重，越小结果越多样
+
+        返回：被选中的候选序号列表
+    """
+    if len(candidates) == 0:
+        return []
+    candidates = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query = query / max(np.linalg.norm(query), 1e-12)
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+
+    selected = [int(np.argmax(relevance))]
+    # 每个候选与已选文档的最大相似度
+    redundancy = similarity[selected[0]].copy()
+    while len(selected) < min(k, len(candidates)):
+        score = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        score[selected] = -np.inf
+        best = int(np.argmax(score))
+        selected.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+    return selected
+
+def file_hash(path:str) -> str:
+    """
+        分块读取文件，计算内容的 md5 值
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+def create_embedding_model(
+    size:int, backend:str="modelscope", num_threads:int=None, max_batch_tokens:int=8192
+) -> ModelScopeEmbeddings:
+    """
+        创建嵌入模型，size 为模型接收的最大序列长度
+        backend: 推理后端，modelscope 为原始的 ModelScope 管线，
+            torch-int8、onnx、onnx-int8 为 CPU 上更快的后端，见 adjustment.embeddings.CPUEncoder
+        num_threads: CPU 后端使用的线程数，为 None 时使用默认值
+        max_batch_tokens: 一次前向计算最多包含的 token 数（含填充），文本按长度分桶，
+            为 None 时每次调用的所有文本作为一批
+    """
+    return ModelScopeEmbeddings(
+        model_id="D:/Data/Models/nlp_gte_sentence-embedding_chinese-base",
+        sequence_length=size,
+        backend=backend,
+        num_threads=num_threads,
+        max_batch_tokens=max_batch_tokens
+        # nlp_gte_sentence-embedding_chinese-base 模型向量维度为 728，可以接收 512 长度以下的文本
+        # nlp_gte_sentence-embedding_chinese-large 模型向量维度为 1024，可以接收 1024 长度以下的文本
+    )
 
 # 自定义的 Embedding 类，用来完成文档的读取和嵌入操作
 class Embedding:
@@ -29,88 +99,829 @@ class Embedding:
     size, cover = 512, 128
     vec_db, vec_id = None, {str}
     embedding_model = None
+    cache = None
+    query_cache = None
+    dispatcher = None
+    lexical = None
+    answers = None
+    qa_layout = "chunk"
+    store = None
+    mmap = False
+    index_config = None
+    sources, refs = None, None
+    tokenizer = None
+    tombstones = None
+    tombstone_filter = None
 
-    def __init__(self, size, cover, db_name:str="default"):
-        self.name, self.size, self.cover = db_name, size, cover
-        self.embedding_model = ModelScopeEmbeddings(
-            model_id="D:/Data/Models/nlp_gte_sentence-embedding_chinese-base",
-            sequence_length=size
-            # nlp_gte_sentence-embedding_chinese-base 模型向量维度为 728，可以接收 512 长度以下的文本
-            # nlp_gte_sentence-embedding_chinese-large 模型向量维度为 1024，可以接收 1024 长度以下的文本
-        )
-        if os.path.exists("./faiss_{}".format(db_name)):
-            self.vec_db = FAISS.load_local("./faiss_{}".format(db_name), self.embedding_model)
-            self.vec_id = {i[1] for i in self.vec_db.index_to_docstore_id.items()}
+    def __init__(
+        self, size, cover, db_name:str="default", cache_path:str="./embedding_cache.db", mmap:bool=False,
+        index_type:str=None, index_params:dict=None, codec:str=None, metric:str=None,
+        query_cache_size:int=1024, query_cache_ttl:float=None, lexical:bool=None, qa_layout:str=None,
+        embedding_model:ModelScopeEmbeddings=None, path:str=None, batch_window:float=None,
+        length_mode:str="char"
+    ):
+        """
+            size: 文本块大小
+            cover: 相邻文本块重叠部分的大小
+            db_name: 向量库名称，向量库保存在 ./faiss_{db_name} 中
+            cache_path: 嵌入向量缓存路径，为 None 时不使用缓存
+            mmap: 是否以只读内存映射方式加载向量库，此时不能再加入文档
+            index_type: 新建向量库时使用的索引类型，可选 flat、ivf、hnsw，默认为 flat
+            index_params: 索引参数，ivf 为 nlist、nprobe，hnsw 为 M、efConstruction、efSearch，
+                pq 压缩为 pq_m、pq_nbits，精排为 refine、k_factor
+            codec: 新建向量库时使用的向量压缩方式，可选 float32、float16、int8、pq，默认为 float32
+            metric: 新建向量库时使用的距离，可选 l2（欧氏距离）、ip（归一化内积，即余弦相似度），默认为 l2
+                已有的向量库使用创建时记录的索引类型、压缩方式和距离，只会更新其中的搜索参数
+            query_cache_size: 查询向量缓存的最大数量，为 0 时不缓存
+            query_cache_ttl: 查询向量缓存的有效时间（秒），为 None 时不过期
+            lexical: 是否维护关键词倒排索引，用于混合检索，为 None 时只在非内存映射模式下使用
+                内存映射模式主要用于快速启动、低内存占用的工作进程，读入整个倒排索引会抵消这些好处
+            qa_layout: 新建向量库时 qa 文件的划分方式，默认为 chunk
+                chunk: 以“问题$answer$答案”为文本块进行嵌入
+                question: 只嵌入问题，答案去重后保存在答案表中，搜索结果仍为“问题$answer$答案”的形式，
+                    且同一个答案只会出现一次
+            embedding_model: 已经创建的嵌入模型，多个向量库可以共享同一个模型，为 None 时新建
+            path: 向量库目录，为 None 时使用 ./faiss_{db_name}
+            batch_window: 多线程并发搜索时，将 batch_window 秒内到达的查询合并为一次嵌入，
+                为 None 时每个查询单独嵌入，见 EmbeddingDispatcher
+            length_mode: size、cover 的计算方式
+                char: 按字符数计算
+                token: 按嵌入模型分词后的 token 数计算，文本块恰好填满模型的序列长度，见 data.TokenCounter
+        """
+        self.name, self.size, self.cover, self.mmap = db_name, size, cover, mmap
+        if embedding_model is None:
+            embedding_model = create_embedding_model(size)
+        self.embedding_model = embedding_model
+        if length_mode == "token":
+            self.tokenizer = self.embedding_model.model_dir()
+        elif length_mode != "char":
+            raise ValueError("Unsupported length mode: {}".format(length_mode))
+        if cache_path is not None:
+            self.cache = EmbeddingCache(cache_path, self.model_name(), size)
+        if query_cache_size > 0:
+            self.query_cache = QueryCache(query_cache_size, query_cache_ttl)
+        if batch_window is not None:
+            self.dispatcher = EmbeddingDispatcher(self.embedding_model, batch_window)
+        self.store = SegmentStore(path or "./faiss_{}".format(db_name))
+        if self.store.exists():
+            self.index_config = self.store.manifest["index"]
+            if index_type is not None and self.index_config["type"] != index_type:
+                print("Warning: 向量库 {} 使用 {} 索引，忽略 index_type={}".format(
+                    db_name, self.index_config["type"], index_type))
+            elif codec is not None and self.index_config["codec"] != codec:
+                print("Warning: 向量库 {} 使用 {} 压缩，忽略 codec={}".format(
+                    db_name, self.index_config["codec"], codec))
+            elif metric is not None and self.index_config["metric"] != metric:
+                print("Warning: 向量库 {} 使用 {} 距离，忽略 metric={}".format(
+                    db_name, self.index_config["metric"], metric))
+            else:
+                # 只有搜索参数可以在创建后修改
+                self.index_config["params"].update({
+                    k: v for k, v in (index_params or {}).items() if k in ["nprobe", "efSearch", "k_factor"]
+                })
+        else:
+            self.index_config = index_config(
+                index_type or "flat", index_params, codec or "float32", metric or "l2")
+        self.store.manifest["index"] = self.index_config
+        if self.store.exists():
+            self.qa_layout = self.store.manifest.get("qa_layout", "chunk")
+            if qa_layout is not None and qa_layout != self.qa_layout:
+                print("Warning: 向量库 {} 使用 {} 划分 qa 文件，忽略 qa_layout={}".format(
+                    db_name, self.qa_layout, qa_layout))
+        else:
+            self.qa_layout = qa_layout or "chunk"
+        self.store.manifest["qa_layout"] = self.qa_layout
+        if self.qa_layout == "question":
+            self.answers = AnswerStore(self.store.path)
+        self.sources, self.refs, self.tombstones = {}, Counter(), set()
+        sources = self.store.load_sources()
+        self.update_sources(sources or {})
+        if lexical is None:
+            lexical = not mmap
+        if mmap:
+            self.vec_db = self.store.load_mmap(self.embedding_model)
+            self.vec_id = {str}
+            if lexical:
+                self.lexical = self.store.load_lexical()
+        elif self.store.exists():
+            self.vec_db = self.store.load_base(self.embedding_model)
+            if lexical:
+                self.lexical = self.store.load_lexical()
+                if self.lexical is None:
+                    # 旧的向量库没有保存倒排索引，从文档库重建，并保存到基础快照中，下次启动时直接读取
+                    self.lexical = NGramIndex()
+                    if self.vec_db is not None:
+                        for _id in self.vec_db.index_to_docstore_id.values():
+                            self.lexical.add(_id, self.vec_db.docstore.search(_id).page_content)
+                        self.store.write_lexical(self.lexical)
+            for texts, embeddings, metadatas, ids, changes, removed in self.store.segments():
+                self.add_embeddings(texts, embeddings, metadatas, ids, persist=False, sources=changes, removed=removed)
+            self.vec_id = set(self.vec_db.docstore._dict.keys()) if self.vec_db is not None else {str}
         else:
             self.vec_db = None
             self.vec_id = {str}
+            if lexical:
+                self.lexical = NGramIndex()
+        if sources is None and self.vec_db is not None:
+            # 旧的向量库没有保存来源索引，按文档的 source 字段重建
+            rebuilt = {}
+            for _id in self.vec_db.index_to_docstore_id.values():
+                doc = self.vec_db.docstore.search(_id) if self.refs[_id] == 0 else None
+                # 带墓碑标记的向量已经不在文档库中
+                if isinstance(doc, Document):
+                    rebuilt.setdefault(os.path.normpath(doc.metadata.get("source", "")), set()).add(_id)
+            for path, ids in rebuilt.items():
+                self.update_sources({path: self.sources.get(path, set()) | ids})
+
+    def load(self, paths:list, bulk:bool=True, batch_size:int=64, workers:int=None, segment_size:int=1024):
+        """
+            加载文件并加入向量库
+            paths: 文件路径列表
+            bulk: 是否使用批量模式，以流的方式读入、划分文件，每收集 segment_size 个新的文本块，
+                分批嵌入后作为一个增量段加入向量库，内存占用不随文件大小增长，见 iter_load_file
+                为 False 时逐个文本块嵌入并加入向量库
+            batch_size: 批量模式下每次嵌入的文本块数量
+            workers: 大于 1 时使用流水线并行加载，解析文件使用 workers 个进程，见 IngestPipeline
 
-    def load(self, paths:list):
-        # 加载文件
+            自上次加载以来没有变化的文件会被直接跳过，不会读取和划分，见 changed_files
+            已经加载过、但内容发生变化的文件使用 upsert_file 更新
+        """
         length = len(paths)
         if length == 0:
             return True if self.vec_db is not None else False
-        else:
-            for i in range(length):
-                print("[{}/{}] Loading: {}".format(i+1, length, paths[i]))
-                docs = LoadFile(
-                    path = paths[i],
-                    size = self.size,
-                    cover = self.cover,
-                    index = True
-                )
+        if self.mmap:
+            raise RuntimeError("内存映射模式下向量库只读，无法加载文件")
+        paths = self.changed_files(paths)
+        for path in [path for path in paths if os.path.normpath(path) in self.sources]:
+            self.upsert_file(path, batch_size)
+        paths = [path for path in paths if os.path.normpath(path) not in self.sources]
+        length = len(paths)
+        if length == 0:
+            return True if self.vec_db is not None else False
+        if not bulk:
+            return self.load_each(paths)
+        if workers is not None and workers > 1:
+            IngestPipeline(self, workers, batch_size).run(paths)
+            self.record_files(paths)
+            if self.cache is not None:
+                print("Embedding cache: {hits} hit(s), {misses} miss(es), {size} vector(s) cached.".format(
+                    **self.cache.stats()))
+            return True if self.vec_db is not None else False
+
+        # pending 为已经收集、还没有写入向量库的文本块，finished 为已经读完、文本块还没有全部写入的文件
+        # 写入成功后才加入 vec_id 和文件清单，中途出错时不会把没有写入的文本块当作已经存在
+        texts, metadatas, ids, sources, added = [], [], [], {}, 0
+        pending, finished = set(), []
+        start_time = time.time()
+        for i in range(length):
+            print("[{}/{}] Loading: {}".format(i+1, length, paths[i]))
+            docs = iter_load_file(
+                path = paths[i],
+                size = self.size,
+                cover = self.cover,
+                index = True,
+                qa_layout = self.qa_layout,
+                tokenizer = self.tokenizer
+            )
 
-                new_docs = 0
-                for doc in docs:
-                    hash_id = hashlib.md5(doc.page_content.encode()).hexdigest()
-                    if hash_id in self.vec_id:
-                        continue
-
-                    new_docs += 1
-                    self.vec_id.update({hash_id})
-                    texts, metadatas, ids = [doc.page_content], [doc.metadata], [hash_id]
-                    
-                    if self.vec_db is None:
-                        self.vec_db = FAISS.from_texts(
-                            texts = texts,
-                            embedding = self.embedding_model,
-                            metadatas = metadatas,
-                            ids = ids
-                        )
-                    else:
-                        self.vec_db.add_texts(
-                            texts = texts,
-                            embedding = self.embedding_model,
-                            metadatas = metadatas,
-                            ids = ids
-                        )
-                print("Successfully loaded new {} document(s), find {} documents(s).".format(new_docs, len(docs)))
-            self.vec_db.save_local("./faiss_{}".format(self.name))
+            new_docs, found = 0, 0
+            path = os.path.normpath(paths[i])
+            sources.setdefault(path, set(self.sources.get(path, set())))
+            for doc in docs:
+                found += 1
+                hash_id = self.doc_id(doc)
+                sources[path].add(hash_id)
+                if hash_id in self.vec_id or hash_id in pending:
+                    continue
+
+                new_docs += 1
+                pending.add(hash_id)
+                texts.append(doc.page_content)
+                metadatas.append(doc.metadata)
+                ids.append(hash_id)
+                if len(texts) >= segment_size:
+                    added += self.add_segment(texts, metadatas, ids, sources, batch_size)
+                    self.record_files(finished)
+                    texts, metadatas, ids, pending, finished = [], [], [], set(), []
+            finished.append(paths[i])
+            print("Found new {} document(s), find {} documents(s).".format(new_docs, found))
+
+        # load 只会加入文本块，文件原有的文本块仍然保留，需要替换时使用 upsert_file
+        added += self.add_segment(texts, metadatas, ids, sources, batch_size)
+        self.record_files(finished)
+        if added > 0:
+            cost = time.time() - start_time
+            print("Successfully loaded new {} document(s) in {:.2f}s, {:.1f} chunks/s.".format(
+                added, cost, added / cost if cost > 0 else float("inf")))
+            if self.cache is not None:
+                print("Embedding cache: {hits} hit(s), {misses} miss(es), {size} vector(s) cached.".format(
+                    **self.cache.stats()))
+        return True if self.vec_db is not None else False
+
+    def add_segment(self, texts:list, metadatas:list, ids:list, sources:dict, batch_size:int=64) -> int:
+        """
+            嵌入一批文本块并加入向量库，同时更新 sources 中发生变化的文件来源
+            写入成功后文本块才会加入 vec_id
+
+            返回：加入的文本块数量
+        """
+        if self.answers is not None:
+            self.answers.flush()
+        sources = {path: part for path, part in sources.items() if part != self.sources.get(path)}
+        if len(texts) == 0 and len(sources) > 0:
+            self.add_embeddings([], [], [], [], sources=sources)
+        if len(texts) > 0:
+            embeddings = self.embed_texts(texts, batch_size, ids)
+            self.add_embeddings(texts, embeddings, metadatas, ids, sources=sources)
+            self.vec_id.update(ids)
+        return len(texts)
+
+    def file_record(self, path:str) -> dict:
+        """
+            文件在文件清单中的记录，划分参数改变后文件需要重新加载
+        """
+        stat = os.stat(path)
+        return {
+            "size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": file_hash(path),
+            "chunk_size": self.size, "cover": self.cover, "qa_layout": self.qa_layout,
+            "length_mode": "token" if self.tokenizer is not None else "char"
+        }
+
+    def unchanged(self, path:str) -> bool:
+        """
+            文件自上次加载以来是否没有变化
+            大小和修改时间都与清单相同时不读取文件；只有修改时间变化时（如文件被复制、touch）再比较内容的 md5 值
+        """
+        record = self.store.files.get(os.path.normpath(path))
+        if record is None or os.path.normpath(path) not in self.sources:
+            return False
+        length_mode = "token" if self.tokenizer is not None else "char"
+        if (record["chunk_size"], record["cover"], record["qa_layout"], record.get("length_mode", "char")) != \
+            (self.size, self.cover, self.qa_layout, length_mode):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != record["size"]:
+            return False
+        if stat.st_mtime_ns == record["mtime"]:
             return True
-    
-    def search(self, s:str, distance:float=0.0) -> list:
+        if file_hash(path) != record["hash"]:
+            return False
+        record["mtime"] = stat.st_mtime_ns
+        return True
+
+    def changed_files(self, paths:list) -> list:
+        """
+            返回：需要重新加载的文件，保持原来的顺序
+        """
+        mtimes = {path: record["mtime"] for path, record in self.store.files.items()}
+        result = [path for path in paths if not self.unchanged(path)]
+        if len(result) < len(paths):
+            print("Skipped {} unchanged file(s).".format(len(paths) - len(result)))
+        if any([record["mtime"] != mtimes[path] for path, record in self.store.files.items()]):
+            self.store.write_files()
+        return result
+
+    def record_files(self, paths:list):
+        """
+            文件加载完成后，将其写入文件清单
+        """
+        if len(paths) == 0:
+            return
+        for path in paths:
+            self.store.files[os.path.normpath(path)] = self.file_record(path)
+        self.store.write_files()
+
+    def load_each(self, paths:list):
+        """
+            逐个文本块嵌入，每个文本块都会调用一次嵌入模型，每个文件作为一个增量段加入向量库
+            与批量模式一样通过 add_embeddings 加入，索引按 index_config 创建
+        """
+        length = len(paths)
+        for i in range(length):
+            print("[{}/{}] Loading: {}".format(i+1, length, paths[i]))
+            docs = LoadFile(
+                path = paths[i],
+                size = self.size,
+                cover = self.cover,
+                index = True,
+                qa_layout = self.qa_layout,
+                tokenizer = self.tokenizer
+            )
+
+            path = os.path.normpath(paths[i])
+            texts, metadatas, ids, current = [], [], [], set(self.sources.get(path, set()))
+            for doc in docs:
+                hash_id = self.doc_id(doc)
+                current.add(hash_id)
+                if hash_id in self.vec_id or hash_id in ids:
+                    continue
+                texts.append(doc.page_content)
+                metadatas.append(doc.metadata)
+                ids.append(hash_id)
+            if self.answers is not None:
+                self.answers.flush()
+            embeddings = self.embed_texts(texts, 1, ids)
+            sources = {path: current} if current != self.sources.get(path) else {}
+            if len(ids) > 0 or len(sources) > 0:
+                self.add_embeddings(texts, embeddings, metadatas, ids, sources=sources)
+            self.vec_id.update(ids)
+            self.record_files([paths[i]])
+            print("Successfully loaded new {} document(s), find {} documents(s).".format(len(ids), len(docs)))
+        return True if self.vec_db is not None else False
+
+    def doc_id(self, doc:Document) -> str:
+        """
+            文本块在向量库中的 id，即文本的 md5 值
+            问题布局下，会将 metadata 中的答案移入答案表，id 同时包含 answer_id，
+            使得相同的问题对应不同答案时不会被去重
+        """
+        answer = doc.metadata.pop("answer", None)
+        if answer is None:
+            return hashlib.md5(doc.page_content.encode()).hexdigest()
+        self.answers.add(doc.metadata["answer_id"], answer)
+        return hashlib.md5((doc.page_content + "$answer$" + doc.metadata["answer_id"]).encode()).hexdigest()
+
+    def resolve(self, docs:list) -> list:
+        """
+            问题布局下，将搜索到的问题还原为“问题$answer$答案”的形式，同一个答案只保留第一次出现
+        """
+        if self.answers is None:
+            return docs
+        result, seen = [], set()
+        for doc in docs:
+            answer_id = doc.metadata.get("answer_id")
+            if answer_id is None:
+                result.append(doc)
+            elif answer_id not in seen:
+                seen.add(answer_id)
+                result.append(Document(
+                    page_content = doc.page_content + "$answer$" + self.answers.get(answer_id),
+                    metadata = dict(doc.metadata)
+                ))
+        return result
+
+    def embed_texts(self, texts:list, batch_size:int=64, ids:list=None) -> list:
+        """
+            分批计算文本的嵌入向量
+            ids: 文本的哈希值，给出时优先从缓存中读取向量，并将新计算的向量写入缓存
+            文本按长度排序后再分批，同一批中的文本长度相近，减少填充
+        """
+        if self.cache is None or ids is None:
+            embeddings = [None] * len(texts)
+            order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+            for i in range(0, len(order), batch_size):
+                part = order[i : i+batch_size]
+                for j, vector in zip(part, self.embedding_model.embed_documents([texts[j] for j in part])):
+                    embeddings[j] = vector
+            return embeddings
+
+        cached = self.cache.get_many(ids)
+        missing = [i for i in range(len(texts)) if ids[i] not in cached]
+        missing.sort(key=lambda i: len(texts[i]))
+        for i in range(0, len(missing), batch_size):
+            part = missing[i : i+batch_size]
+            vectors = self.embedding_model.embed_documents([texts[j] for j in part])
+            self.cache.put_many([ids[j] for j in part], vectors)
+            cached.update(zip([ids[j] for j in part], vectors))
+        return [cached[hash_id] for hash_id in ids]
+
+    def add_embeddings(
+        self, texts:list, embeddings:list, metadatas:list, ids:list, persist:bool=True,
+        sources:dict=None, removed:list=None
+    ):
+        """
+            将已经计算好的嵌入向量一次性加入向量库
+            persist: 是否将这些向量作为增量段写入磁盘
+            sources: 需要更新的来源索引，{文件路径: 文件现在包含的全部文本块 id}
+            removed: 需要删除的文本块 id，在加入新的向量之后删除
+        """
+        with self.store.lock:
+            if len(ids) > 0:
+                self.insert(texts, embeddings, metadatas, ids)
+            self.update_sources(sources or {})
+            self.delete_ids(removed or [])
+            if persist:
+                self.store.append(
+                    texts, embeddings, metadatas, ids,
+                    {path: sorted(i) for path, i in (sources or {}).items()}, removed
+                )
+        if persist and (self.store.need_compact() or self.need_purge()):
+            self.compact()
+
+    def insert(self, texts:list, embeddings:list, metadatas:list, ids:list):
+        with self.store.lock:
+            if self.vec_db is None:
+                self.vec_db = FAISS(
+                    embedding_function = self.embedding_model,
+                    index = create_index(len(embeddings[0]), self.index_config, embeddings),
+                    docstore = InMemoryDocstore(),
+                    index_to_docstore_id = {},
+                    **store_kwargs(self.index_config)
+                )
+            self.vec_db.add_embeddings(
+                text_embeddings = list(zip(texts, embeddings)),
+                metadatas = metadatas,
+                ids = ids
+            )
+            if self.lexical is not None:
+                self.lexical.add_many(ids, texts)
+
+    def update_sources(self, sources:dict):
+        """
+            替换若干文件在来源索引中的文本块，同时维护每个文本块被多少个文件引用
+        """
+        for path, ids in sources.items():
+            self.refs.subtract(self.sources.pop(path, set()))
+            if len(ids) > 0:
+                self.sources[path] = set(ids)
+                self.refs.update(self.sources[path])
+        self.refs = +self.refs
+
+    def delete_ids(self, ids:list):
+        """
+            从向量库中删除文本块
+            flat 索引直接删除向量；ivf 索引删除后序号不会前移，hnsw 和精排索引不支持删除，
+            这些索引只从文档库中删除并在 tombstones 中记录向量序号，搜索时跳过，合并时再重建索引
+        """
+        ids = [_id for _id in ids if self.vec_db is not None and _id in self.vec_db.docstore._dict]
+        if len(ids) == 0:
+            return
+        with self.store.lock:
+            if self.lexical is not None:
+                for _id in ids:
+                    self.lexical.remove(_id, self.vec_db.docstore.search(_id).page_content)
+            targets = set(ids)
+            positions = [
+                i for i, _id in self.vec_db.index_to_docstore_id.items()
+                if _id in targets and i not in self.tombstones
+            ]
+            self.vec_db.docstore.delete(ids)
+            if self.index_config["type"] == "flat" and self.index_config["params"]["refine"] is None:
+                # flat 索引删除向量后，后面的向量序号依次前移
+                self.vec_db.index.remove_ids(np.array(positions, dtype=np.int64))
+                dead = set(positions)
+                self.vec_db.index_to_docstore_id = {
+                    n: _id for n, _id in enumerate([
+                        _id for i, _id in sorted(self.vec_db.index_to_docstore_id.items()) if i not in dead
+                    ])
+                }
+            else:
+                self.tombstones.update(positions)
+            self.vec_id.difference_update(ids)
+
+    def need_purge(self) -> bool:
+        """
+            被标记删除的向量超过索引的五分之一时，需要重建索引
+        """
+        return self.vec_db is not None and len(self.tombstones) * 5 > self.vec_db.index.ntotal
+
+    def purge(self):
+        """
+            重建索引，真正删除带墓碑标记的向量
+            从原索引中取回剩余的向量，加入一个复制了训练结果的空索引中，不需要重新训练
+        """
+        if len(self.tombstones) == 0:
+            return
+        with self.store.lock:
+            index = self.vec_db.index
+            live = np.array([i for i in range(index.ntotal) if i not in self.tombstones], dtype=np.int64)
+            rebuilt = faiss.clone_index(index)
+            rebuilt.reset()
+            if len(live) > 0:
+                rebuilt.add(index.reconstruct_batch(live))
+            tune_index(rebuilt, self.index_config)
+            self.vec_db.index = rebuilt
+            self.vec_db.index_to_docstore_id = {
+                n: self.vec_db.index_to_docstore_id[int(i)] for n, i in enumerate(live)
+            }
+            self.tombstones = set()
+            self.tombstone_filter = None
+
+    def retrain(self):
+        """
+            训练向量不足时索引暂时是暴力搜索，见 create_index；
+            向量数量足够后，用全部向量按配置训练新的索引并重新加入
+        """
+        index = self.vec_db.index
+        if not is_staging(index, self.index_config) or index.ntotal < train_size(self.index_config):
+            return
+        with self.store.lock:
+            index = self.vec_db.index
+            vectors = index.reconstruct_n(0, index.ntotal)
+            rebuilt = create_index(index.d, self.index_config, vectors)
+            rebuilt.add(vectors)
+            self.vec_db.index = rebuilt
+            self.tombstone_filter = None
+
+    def compact(self, background:bool=True):
+        """
+            重建带删除标记的索引，并将向量库合并为新的基础快照
+            训练向量不足时暂时使用的暴力搜索索引，在向量足够后按配置重建
+        """
+        if self.vec_db is not None:
+            self.purge()
+            self.retrain()
+            self.store.compact(self.vec_db, self.lexical, background, self.sources)
+
+    def save(self):
+        """
+            将整个向量库合并保存为新的基础快照
+        """
+        self.compact(background=False)
+
+    def remove_source(self, path:str) -> int:
+        """
+            删除某个文件的全部文本块，仍被其它文件引用的文本块会被保留
+
+            返回：删除的文本块数量
+        """
+        if self.mmap:
+            raise RuntimeError("内存映射模式下向量库只读，无法删除文件")
+        path = os.path.normpath(path)
+        if self.store.files.pop(path, None) is not None:
+            self.store.write_files()
+        if path not in self.sources:
+            return 0
+        removed = sorted([_id for _id in self.sources[path] if self.refs[_id] == 1])
+        self.add_embeddings([], [], [], [], sources={path: set()}, removed=removed)
+        print("Removed {} document(s) of {}.".format(len(removed), path))
+        return len(removed)
+
+    def upsert_file(self, path:str, batch_size:int=64) -> tuple:
+        """
+            重新加载一个已经修改过的文件：只嵌入内容发生变化的文本块，
+            并删除文件中已经不存在、也没有被其它文件引用的旧文本块
+
+            返回：(加入的文本块数量, 删除的文本块数量)
+        """
+        if self.mmap:
+            raise RuntimeError("内存映射模式下向量库只读，无法加载文件")
+        if len(self.changed_files([path])) == 0:
+            print("{} is up to date.".format(path))
+            return 0, 0
+        docs = LoadFile(
+            path = path,
+            size = self.size,
+            cover = self.cover,
+            index = True,
+            qa_layout = self.qa_layout,
+            tokenizer = self.tokenizer
+        )
+        path = os.path.normpath(path)
+        texts, metadatas, ids, current = [], [], [], set()
+        for doc in docs:
+            hash_id = self.doc_id(doc)
+            if hash_id in current:
+                continue
+            current.add(hash_id)
+            if hash_id not in self.vec_id:
+                texts.append(doc.page_content)
+                metadatas.append(doc.metadata)
+                ids.append(hash_id)
+        if self.answers is not None:
+            self.answers.flush()
+        removed = sorted([
+            _id for _id in self.sources.get(path, set()) - current if self.refs[_id] == 1
+        ])
+        if len(ids) == 0 and len(removed) == 0 and current == self.sources.get(path, set()):
+            self.record_files([path])
+            print("{} is up to date.".format(path))
+            return 0, 0
+        embeddings = self.embed_texts(texts, batch_size, ids) if len(texts) > 0 else []
+        self.add_embeddings(texts, embeddings, metadatas, ids, sources={path: current}, removed=removed)
+        self.vec_id.update(ids)
+        self.record_files([path])
+        print("Updated {}: {} new document(s), {} removed document(s).".format(path, len(ids), len(removed)))
+        return len(ids), len(removed)
+
+    def model_name(self) -> str:
+        """
+            嵌入模型的名称，不同推理后端得到的向量略有差异，不共用缓存
+        """
+        backend = getattr(self.embedding_model, "backend", "modelscope")
+        if backend == "modelscope":
+            return self.embedding_model.model_id
+        return "{}#{}".format(self.embedding_model.model_id, backend)
+
+    def model_key(self) -> tuple:
+        """
+            当前嵌入模型的标识，用作查询向量缓存键的一部分
+        """
+        return (self.model_name(), self.embedding_model.model_revision, self.size)
+
+    def embed_queries(self, questions:list, batch_size:int=64) -> list:
+        """
+            计算查询向量，优先从查询向量缓存中读取，未命中的查询一次批量嵌入
+        """
+        if self.query_cache is None:
+            return self.embed_missing(questions, batch_size)
+        model_key = self.model_key()
+        vectors = [self.query_cache.get(model_key, q) for q in questions]
+        missing = [i for i in range(len(questions)) if vectors[i] is None]
+        if len(missing) > 0:
+            embeddings = self.embed_missing([questions[i] for i in missing], batch_size)
+            for i, vector in zip(missing, embeddings):
+                vectors[i] = vector
+                self.query_cache.put(model_key, questions[i], vector)
+        return vectors
+
+    def embed_missing(self, questions:list, batch_size:int=64) -> list:
+        """
+            嵌入缓存中没有的查询，少量查询交给 dispatcher 与其它线程的查询合并
+        """
+        if self.dispatcher is not None and len(questions) <= self.dispatcher.max_batch:
+            return self.dispatcher.embed(questions)
+        return self.embed_texts(questions, batch_size)
+
+    def query_vectors(self, questions:list, batch_size:int=64):
+        """
+            计算查询向量矩阵，ip 索引中的查询向量会被归一化
+        """
+        vectors = np.array(self.embed_queries(questions, batch_size), dtype=np.float32)
+        if self.index_config["metric"] == "ip":
+            faiss.normalize_L2(vectors)
+        return vectors
+
+    def search(
+        self, s:str, distance:float=0.0, mode:str="vector", k:int=5, fetch_k:int=20, lambda_mult:float=0.5
+    ) -> list:
         """
             根据输入的句子在向量库中搜索相似文档
             s: 输入的句子
-            distance: 向量余弦值阈值，越小越相似
+            distance: 只保留得分大于该值的文档
+                l2 索引的得分是欧氏距离的平方，越小越相似；ip 索引的得分是余弦相似度，越大越相似
+                需要按余弦相似度阈值检索时，请使用 range_search
+            mode: 检索方式
+                vector: 只使用向量检索
+                hybrid: 同时使用向量检索和关键词检索，各取 fetch_k 个结果，以倒数排名融合
+                mmr: 取 fetch_k 个候选，用最大边际相关性从中选出 k 个内容不重复的文档
+            k: 返回的最多文档数量
+            lambda_mult: mmr 中相关性的权重，越小结果越多样
         """
         if self.vec_db is not None:
-            result = self.vec_db.similarity_search_with_score(
-                query = s,
-                k = 5, fetch_k = 20
-            )
-            return [doc for doc, _ in result if _ > distance]
+            if mode == "mmr":
+                return self.mmr_search(s, distance, k, fetch_k, lambda_mult)
+            if mode == "hybrid" and self.lexical is not None:
+                vector_ids = [
+                    _id for _id, _ in self.vector_search([s], fetch_k)[0] if _ > distance
+                ]
+                lexical_ids = [_id for _id, _ in self.lexical.search(s, fetch_k)]
+                # 问题布局下，多个问题可能对应同一个答案，先去重再截取
+                fused = reciprocal_rank_fusion([vector_ids, lexical_ids])
+                if self.answers is None:
+                    fused = fused[:k]
+                return self.resolve([self.vec_db.docstore.search(_id) for _id in fused])[:k]
+            result = self.vector_search([s], k if self.answers is None else fetch_k)[0]
+            return self.resolve([self.vec_db.docstore.search(_id) for _id, _ in result if _ > distance])[:k]
         else:
             return []
 
+    def mmr_search(self, s:str, distance:float=0.0, k:int=5, fetch_k:int=20, lambda_mult:float=0.5) -> list:
+        """
+            最大边际相关性检索，候选向量直接从索引中取回，不会重新嵌入
+        """
+        vector = self.query_vectors([s])
+        scores, indices = self.index_search(vector, fetch_k)
+        keep = (indices[0] >= 0) & (scores[0] > distance)
+        indices = indices[0][keep]
+        candidates = self.vec_db.index.reconstruct_batch(indices)
+        selected = maximal_marginal_relevance(vector[0], candidates, k, lambda_mult)
+        return self.resolve([
+            self.vec_db.docstore.search(self.vec_db.index_to_docstore_id[int(indices[i])])
+            for i in selected
+        ])
+
+    def search_filter(self):
+        """
+            返回：跳过带墓碑标记的向量的搜索参数，没有墓碑或索引不支持过滤时返回 None
+            只在墓碑变化后重建，墓碑只会增加，直到 purge 清空，重建索引时清除缓存
+        """
+        if len(self.tombstones) == 0:
+            return None
+        cached = self.tombstone_filter
+        if cached is None or cached[0] != len(self.tombstones):
+            selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(np.array(sorted(self.tombstones), dtype=np.int64)))
+            cached = self.tombstone_filter = (len(self.tombstones), search_params(self.vec_db.index, selector))
+        return cached[1]
+
+    def index_search(self, vectors, k:int):
+        """
+            在索引中搜索 k 个最近邻，跳过带墓碑标记的向量，不足 k 个时以 -1 补齐
+            支持过滤的索引在搜索时直接跳过，其余的多取 len(tombstones) 个结果后再过滤
+        """
+        if len(self.tombstones) == 0:
+            return self.vec_db.index.search(vectors, k)
+        params = self.search_filter()
+        if params is not None:
+            return self.vec_db.index.search(vectors, k, params=params)
+        scores, indices = self.vec_db.index.search(vectors, k + len(self.tombstones))
+        dead = np.isin(indices, list(self.tombstones)) | (indices < 0)
+        # 稳定排序，把被删除的向量移到每行末尾，其余结果保持原来的顺序
+        order = np.argsort(dead, axis=1, kind="stable")[:, :k]
+        scores = np.take_along_axis(scores, order, axis=1)
+        indices = np.take_along_axis(np.where(dead, -1, indices), order, axis=1)
+        return scores, indices
+
+    def vector_search(self, questions:list, k:int=5, batch_size:int=64) -> list:
+        """
+            批量向量检索
+
+            返回：与 questions 一一对应的 [(文档 id, 距离)] 列表
+        """
+        scores, indices = self.index_search(self.query_vectors(questions, batch_size), k)
+        return [
+            [(self.vec_db.index_to_docstore_id[i], score) for i, score in zip(indices[row], scores[row]) if i >= 0]
+            for row in range(len(questions))
+        ]
+
+    def similarity(self, scores):
+        """
+            将索引返回的得分转换为余弦相似度，l2 索引假设向量已经归一化
+        """
+        if self.index_config["metric"] == "ip":
+            return scores
+        return 1 - np.asarray(scores) / 2
+
+    def memory_usage(self) -> int:
+        """
+            估计向量库占用的内存字节数，内存映射方式加载的部分不计入
+        """
+        if self.vec_db is None:
+            return 0
+        index = self.vec_db.index
+        try:
+            size = index.ntotal * index.sa_code_size()
+        except RuntimeError:
+            size = index.ntotal * index.d * 4
+        if not self.mmap:
+            size += sum([len(doc.page_content.encode()) for doc in self.vec_db.docstore._dict.values()])
+        if self.lexical is not None:
+            size += self.lexical.memory_usage()
+        return size
+
+    def range_search(self, s:str, threshold:float=0.5, max_results:int=20) -> list:
+        """
+            返回所有与输入句子的余弦相似度大于 threshold 的文档，按相似度从高到低排列，最多 max_results 个
+            ip 索引直接以 threshold 为半径；l2 索引假设向量已经归一化（GTE 模型的输出），
+            此时欧氏距离的平方 d = 2 - 2cos，半径为 2 - 2 * threshold
+            不支持范围搜索的索引（如 HNSW）会退化为取 max_results 个结果后过滤
+        """
+        if self.vec_db is None:
+            return []
+        vector = self.query_vectors([s])
+        ip = self.index_config["metric"] == "ip"
+        radius = threshold if ip else 2 - 2 * threshold
+        params = self.search_filter()
+        try:
+            _, scores, indices = self.vec_db.index.range_search(vector, radius, params=params)
+            if params is None and len(self.tombstones) > 0:
+                keep = ~np.isin(indices, list(self.tombstones))
+                scores, indices = scores[keep], indices[keep]
+        except RuntimeError:
+            # index_search 已经跳过了带墓碑标记的向量
+            scores, indices = self.index_search(vector, max_results)
+            scores, indices = scores[0], indices[0]
+            keep = (indices >= 0) & ((scores > radius) if ip else (scores < radius))
+            scores, indices = scores[keep], indices[keep]
+        similarity = self.similarity(scores)
+        order = np.argsort(-similarity, kind="stable")[:max_results]
+        return self.resolve([
+            self.vec_db.docstore.search(self.vec_db.index_to_docstore_id[int(indices[i])])
+            for i in order
+        ])
+
+    def search_many(self, questions:list, k:int=5, distance:float=0.0, batch_size:int=64) -> list:
+        """
+            批量搜索，一次嵌入所有问题，并在向量库中一次完成搜索
+            questions: 输入的句子列表
+            k: 每个句子返回的最多文档数量
+            distance: 与 search 相同的阈值
+
+            返回：与 questions 一一对应的文档列表
+        """
+        if self.vec_db is None or len(questions) == 0:
+            return [[] for _ in questions]
+        # 问题布局下，多个问题可能对应同一个答案，多取一些候选
+        fetch_k = k if self.answers is None else k * 4
+        scores, indices = self.index_search(self.query_vectors(questions, batch_size), fetch_k)
+        keep = (scores > distance) & (indices >= 0)
+        result = []
+        for row in range(len(questions)):
+            result.append(self.resolve([
+                self.vec_db.docstore.search(self.vec_db.index_to_docstore_id[i])
+                for i in indices[row][keep[row]]
+            ])[:k])
+        return result
+
 if __name__ == "__main__":
     a = Embedding(size=512, cover=64, db_name="QA")
     a.load(['南哪QA.qa'])
 
     qa = json.load(open('南哪23级本科①群.txt.qa', 'r', encoding='utf-8'))
+    results = a.search_many([item['Q'] for item in qa])
     for it in range(len(qa)):
         item = qa[it]
-        result = a.search(item['Q'])
+        result = results[it]
         print('原问题：{}\n原答案：{}\n'.format(item['Q'], item['A']))
         for i in range(len(result)):
             print('[{}] QA内容：{}'.format(i, result[i].page_content))
@@ -0,0 +1,225 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from data import LoadFile
+
+"""
+    流水线式并行加载：解析划分、嵌入、写入向量库三个阶段同时进行
+"""
+
+def parse_file(path:str, size:int, cover:int, qa_layout:str="chunk", tokenizer:str=None) -> tuple:
+    """
+        在子进程中读取并划分文件，需要是模块级函数才能被子进程调用
+    """
+    start_time = time.time()
+    docs = LoadFile(
+        path = path,
+        size = size,
+        cover = cover,
+        index = True,
+        qa_layout = qa_layout,
+        tokenizer = tokenizer
+    )
+    return path, docs, time.time() - start_time
+
+class StageStats:
+    """
+        记录流水线某个阶段的处理数量和忙碌时间
+    """
+    name: str
+    count: int = 0
+    busy: float = 0.0
+
+    def __init__(self, name:str):
+        self.name, self.count, self.busy = name, 0, 0.0
+
+    def __str__(self) -> str:
+        return "{}: {} item(s) in {:.2f}s, {:.1f} items/s".format(
+            self.name, self.count, self.busy, self.count / self.busy if self.busy > 0 else float("inf"))
+
+class IngestPipeline:
+    """
+        解析划分（进程池） -> 去重、分批嵌入（线程） -> 写入向量库（单个线程）
+        各阶段之间以有界队列相连，下游处理不过来时上游会等待，内存占用不会随文件数量增长
+        去重和写入都只在一个线程中进行，不需要修改 Embedding 的数据结构
+    """
+    embedding = None
+    workers: int = None
+    batch_size: int = 64
+    segment_size: int = 1024
+    queue_size: int = 8
+    stats: dict = {}
+    error = None
+
+    def __init__(
+        self, embedding, workers:int=None, batch_size:int=64,
+        segment_size:int=1024, queue_size:int=8
+    ):
+        """
+            embedding: 要加入的 Embedding 对象
+            workers: 解析文件的进程数，为 None 时使用 CPU 核数
+            batch_size: 每次嵌入的文本块数量
+            segment_size: 每个写入磁盘的增量段至少包含的文本块数量
+            queue_size: 阶段之间队列的长度
+        """
+        self.embedding, self.workers = embedding, workers
+        self.batch_size, self.segment_size, self.queue_size = batch_size, segment_size, queue_size
+        self.stats = {}
+        self.error = None
+
+    def run(self, paths:list) -> dict:
+        """
+            加载文件并加入向量库
+
+            返回：各阶段的统计信息
+        """
+        self.stats = {name: StageStats(name) for name in ("parse", "embed", "write")}
+        self.error = None
+        parsed = queue.Queue(self.queue_size)
+        embedded = queue.Queue(self.queue_size)
+        threads = [
+            threading.Thread(target=self.guard, args=(self.embed_stage, parsed, embedded), daemon=True),
+            threading.Thread(target=self.guard, args=(self.write_stage, embedded), daemon=True)
+        ]
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        try:
+            self.parse_stage(paths, parsed)
+        finally:
+            self.put(parsed, None)
+            for thread in threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error
+
+        cost = time.time() - start_time
+        for stage in self.stats.values():
+            print(stage)
+        print("Pipeline finished in {:.2f}s, {:.1f} chunks/s.".format(
+            cost, self.stats["write"].count / cost if cost > 0 else float("inf")))
+        return self.stats
+
+    def guard(self, target, *args):
+        """
+            记录阶段中的异常，并继续消费上游队列，避免上游阻塞
+        """
+        try:
+            target(*args)
+        except BaseException as e:
+            if self.error is None:
+                self.error = e
+            source = args[0]
+            while source.get() is not None:
+                pass
+        finally:
+            if len(args) > 1:
+                self.put(args[1], None)
+
+    def put(self, target:queue.Queue, item):
+        while True:
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self.error is not None and item is not None:
+                    return
+
+    def parse_stage(self, paths:list, parsed:queue.Queue):
+        embedding = self.embedding
+        length = len(paths)
+        with ProcessPoolExecutor(self.workers) as executor:
+            pending, index = set(), 0
+            while index < length or len(pending) > 0:
+                # 同时提交的文件数量有限，避免解析结果堆积在内存中
+                while index < length and len(pending) < self.queue_size:
+                    pending.add(executor.submit(
+                        parse_file, paths[index], embedding.size, embedding.cover,
+                        embedding.qa_layout, embedding.tokenizer))
+                    index += 1
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, docs, cost = future.result()
+                    self.stats["parse"].count += 1
+                    self.stats["parse"].busy += cost
+                    print("[{}/{}] Loaded: {}, {} document(s).".format(
+                        self.stats["parse"].count, length, path, len(docs)))
+                    self.put(parsed, (path, docs))
+                if self.error is not None:
+                    for future in pending:
+                        future.cancel()
+                    return
+
+    def embed_stage(self, parsed:queue.Queue, embedded:queue.Queue):
+        embedding = self.embedding
+        # pending 为本次加载已经收集的文本块，写入成功后才会由 write_stage 加入 vec_id
+        # 文件的来源随它最后一个文本块所在的批次发出，保证来源写入时文本块都已经写入
+        texts, metadatas, ids, sources = [], [], [], {}
+        pending, finished, collected, emitted = set(), [], 0, 0
+        while True:
+            item = parsed.get()
+            docs = None if item is None else item[1]
+            if docs is not None:
+                path = os.path.normpath(item[0])
+                current = set(embedding.sources.get(path, set()))
+                for doc in docs:
+                    hash_id = embedding.doc_id(doc)
+                    current.add(hash_id)
+                    if hash_id in embedding.vec_id or hash_id in pending:
+                        continue
+                    pending.add(hash_id)
+                    texts.append(doc.page_content)
+                    metadatas.append(doc.metadata)
+                    ids.append(hash_id)
+                    collected += 1
+                finished.append((collected, path, current))
+            while len(texts) >= self.batch_size or (docs is None and len(texts) > 0):
+                start_time = time.time()
+                part = slice(0, self.batch_size)
+                vectors = embedding.embed_texts(texts[part], self.batch_size, ids[part])
+                self.stats["embed"].count += len(vectors)
+                self.stats["embed"].busy += time.time() - start_time
+                emitted += len(vectors)
+                while len(finished) > 0 and finished[0][0] <= emitted:
+                    _, path, current = finished.pop(0)
+                    sources[path] = current
+                # 问题布局下，文本块引用的答案要先于增量段写入答案表
+                if embedding.answers is not None:
+                    embedding.answers.flush()
+                self.put(embedded, (texts[part], vectors, metadatas[part], ids[part], sources))
+                del texts[part], metadatas[part], ids[part]
+                sources = {}
+            if docs is None:
+                for _, path, current in finished:
+                    sources[path] = current
+                if embedding.answers is not None:
+                    embedding.answers.flush()
+                if len(sources) > 0:
+                    # 没有新文本块的文件，也需要记录来源
+                    self.put(embedded, ([], [], [], [], sources))
+                return
+
+    def write_stage(self, embedded:queue.Queue):
+        embedding = self.embedding
+        texts, vectors, metadatas, ids, sources = [], [], [], [], {}
+        while True:
+            item = embedded.get()
+            if item is not None:
+                for target, part in zip((texts, vectors, metadatas, ids), item):
+                    target += part
+                for path, part in item[4].items():
+                    sources.setdefault(path, set()).update(part)
+            # 攒够一个增量段再写入，避免产生大量很小的段
+            if len(texts) >= self.segment_size or (item is None and (len(texts) > 0 or len(sources) > 0)):
+                start_time = time.time()
+                sources = {path: part for path, part in sources.items() if part != embedding.sources.get(path)}
+                embedding.add_embeddings(texts, vectors, metadatas, ids, sources=sources)
+                embedding.vec_id.update(ids)
+                self.stats["write"].count += len(texts)
+                self.stats["write"].busy += time.time() - start_time
+                texts, vectors, metadatas, ids, sources = [], [], [], [], {}
+            if item is None:
+                return
@@ -0,0 +1,241 @@
+import re
+import sys
+import math
+import pickle
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+import numpy as np
+
+"""
+    基于字符 n-gram 倒排索引的关键词检索
+"""
+
+class NGramIndex:
+    """
+        以字符二元组、三元组为词项的倒排索引，使用 BM25 打分
+        中文不需要分词，短关键词（如“红黑榜”、课程编号）也能被准确命中
+
+        文档按加入顺序编号为整数行号，ids[行号] 为文档 id，删除后为 None
+        每个词项的倒排表为升序的 int32 行号和对应的 uint16 词频两个数组，搜索时用 numpy 一次性打分
+        从快照加载的倒排表拼接保存在 packed 中，不为每个词项单独建立对象，
+        某个词项的倒排表第一次被修改时才复制到 postings 中，之后以 postings 中的为准
+    """
+    ns: tuple = (2, 3)
+    k1: float = 1.5
+    b: float = 0.75
+    max_df: float = 0.5
+    postings: dict = {}
+    packed: tuple = None
+    ids: list = []
+    rows: dict = {}
+    lengths: array = None
+    total: int = 0
+    norm: tuple = None
+
+    def __init__(self, ns:tuple=(2, 3), k1:float=1.5, b:float=0.75, max_df:float=0.5):
+        """
+            ns: 使用的 n-gram 长度
+            k1, b: BM25 参数
+            max_df: 出现在超过这一比例的文档中的词项 idf 接近 0，搜索时跳过，
+                查询中所有词项都超过时不跳过
+        """
+        self.ns, self.k1, self.b, self.max_df = ns, k1, b, max_df
+        self.postings = {}
+        self.packed = ({}, np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint16))
+        self.ids = []
+        self.rows = {}
+        self.lengths = array("i")
+        self.total = 0
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def grams(self, text:str) -> Counter:
+        """
+            将文本切分为字符 n-gram，空白字符处断开
+        """
+        result = Counter()
+        for piece in re.split(r"\s+", text.lower()):
+            for n in self.ns:
+                for i in range(len(piece) - n + 1):
+                    result[piece[i : i+n]] += 1
+        return result
+
+    def posting(self, gram:str) -> tuple:
+        """
+            返回：词项的 (行号, 词频) numpy 数组，不存在时返回 None
+        """
+        posting = self.postings.get(gram)
+        if posting is not None:
+            # 复制为 numpy 数组，倒排表在搜索期间被其它线程修改时不受影响
+            rows, tfs = np.array(posting[0], dtype=np.int32), np.array(posting[1], dtype=np.uint16)
+        else:
+            index, offsets, rows, tfs = self.packed
+            i = index.get(gram)
+            if i is None:
+                return None
+            rows, tfs = rows[offsets[i] : offsets[i+1]], tfs[offsets[i] : offsets[i+1]]
+        return (rows, tfs) if len(rows) > 0 else None
+
+    def editable(self, gram:str, create:bool) -> tuple:
+        """
+            返回：词项可以修改的倒排表，不存在且 create 为 False 时返回 None
+        """
+        posting = self.postings.get(gram)
+        if posting is None:
+            index, offsets, rows, tfs = self.packed
+            i = index.get(gram)
+            if i is None and not create:
+                return None
+            posting = (array("i"), array("H"))
+            if i is not None:
+                posting[0].frombytes(rows[offsets[i] : offsets[i+1]].tobytes())
+                posting[1].frombytes(tfs[offsets[i] : offsets[i+1]].tobytes())
+            self.postings[gram] = posting
+        return posting
+
+    def add(self, doc_id:str, text:str):
+        if doc_id in self.rows:
+            return
+        row = len(self.ids)
+        grams = self.grams(text)
+        for gram, tf in grams.items():
+            posting = self.editable(gram, True)
+            posting[0].append(row)
+            posting[1].append(min(tf, 65535))
+        length = sum(grams.values())
+        self.ids.append(doc_id)
+        self.rows[doc_id] = row
+        self.lengths.append(length)
+        self.total += length
+
+    def add_many(self, ids:list, texts:list):
+        for doc_id, text in zip(ids, texts):
+            self.add(doc_id, text)
+
+    def remove(self, doc_id:str, text:str):
+        """
+            删除文档，需要给出文档的原文以找到对应的词项
+        """
+        row = self.rows.pop(doc_id, None)
+        if row is None:
+            return
+        for gram in self.grams(text):
+            posting = self.editable(gram, False)
+            if posting is None:
+                continue
+            i = bisect_left(posting[0], row)
+            if i < len(posting[0]) and posting[0][i] == row:
+                del posting[0][i], posting[1][i]
+                # packed 中的词项保留空的倒排表，覆盖 packed 中的旧内容
+                if len(posting[0]) == 0 and gram not in self.packed[0]:
+                    del self.postings[gram]
+        self.ids[row] = None
+        self.total -= self.lengths[row]
+        self.lengths[row] = 0
+
+    def search(self, query:str, k:int=5) -> list:
+        """
+            返回：按 BM25 分数从高到低排列的 [(文档 id, 分数)]
+        """
+        count = len(self.rows)
+        if count == 0:
+            return []
+        average = self.total / count
+        terms = [(self.posting(gram), qtf) for gram, qtf in self.grams(query).items()]
+        terms = [term for term in terms if term[0] is not None]
+        terms = [term for term in terms if len(term[0][0]) <= self.max_df * count] or terms
+        if len(terms) == 0:
+            return []
+        # 文档长度归一化项只在文档变化后重新计算
+        key = (len(self.ids), count, self.total)
+        if self.norm is None or self.norm[0] != key:
+            self.norm = (key, self.k1 * (1 - self.b + self.b * np.array(self.lengths, dtype=np.float64) / average))
+        norm = self.norm[1]
+        scores = np.zeros(len(norm))
+        for (rows, tfs), qtf in terms:
+            if rows[-1] >= len(norm):
+                # 计算 norm 之后才加入的文档，留给下一次搜索
+                rows, tfs = rows[rows < len(norm)], tfs[rows < len(norm)]
+            df = len(rows)
+            idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+            tfs = tfs.astype(np.float64)
+            # 同一个倒排表中的行号互不相同，可以直接按下标累加
+            scores[rows] += qtf * idf * tfs * (self.k1 + 1) / (tfs + norm[rows])
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(self.ids[i], float(scores[i])) for i in hits]
+
+    def memory_usage(self) -> int:
+        """
+            返回：倒排索引占用的内存字节数
+        """
+        index, offsets, rows, tfs = self.packed
+        size = sys.getsizeof(index) + sum([sys.getsizeof(gram) for gram in index])
+        size += offsets.nbytes + rows.nbytes + tfs.nbytes
+        size += sys.getsizeof(self.postings) + sys.getsizeof(self.rows) + sys.getsizeof(self.ids)
+        size += sys.getsizeof(self.lengths) + sum([sys.getsizeof(_id) for _id in self.rows])
+        for gram, (rows, tfs) in self.postings.items():
+            size += sys.getsizeof(gram) + sys.getsizeof(rows) + sys.getsizeof(tfs) + 56
+        return size
+
+    def dumps(self) -> bytes:
+        """
+            所有倒排表依次拼接为两个数组保存，加载时不需要为每个词项建立对象
+        """
+        grams = [gram for gram in self.packed[0] if gram not in self.postings] + list(self.postings.keys())
+        postings = [self.posting(gram) for gram in grams]
+        grams = [gram for gram, posting in zip(grams, postings) if posting is not None]
+        postings = [posting for posting in postings if posting is not None]
+        counts = np.array([len(rows) for rows, _ in postings], dtype=np.int64)
+        return pickle.dumps({
+            "ns": self.ns, "k1": self.k1, "b": self.b, "max_df": self.max_df,
+            "ids": self.ids, "lengths": self.lengths.tobytes(), "total": self.total,
+            "grams": grams, "offsets": np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            "rows": np.concatenate([rows for rows, _ in postings] or [np.zeros(0, dtype=np.int32)]),
+            "tfs": np.concatenate([tfs for _, tfs in postings] or [np.zeros(0, dtype=np.uint16)])
+        })
+
+    @staticmethod
+    def loads(data:bytes) -> "NGramIndex":
+        data = pickle.loads(data)
+        index = NGramIndex()
+        if isinstance(data, tuple):
+            # 旧格式：{词项: {文档 id: 词频}}
+            ns, k1, b, postings, lengths, _ = data
+            index = NGramIndex(ns, k1, b)
+            for doc_id, length in lengths.items():
+                index.rows[doc_id] = len(index.ids)
+                index.ids.append(doc_id)
+                index.lengths.append(length)
+                index.total += length
+            for gram, posting in postings.items():
+                rows = sorted([(index.rows[doc_id], min(tf, 65535)) for doc_id, tf in posting.items()])
+                index.postings[gram] = (array("i", [row for row, _ in rows]), array("H", [tf for _, tf in rows]))
+            return index
+
+        index.ns, index.k1, index.b, index.max_df = data["ns"], data["k1"], data["b"], data["max_df"]
+        index.ids, index.total = data["ids"], data["total"]
+        index.rows = {doc_id: row for row, doc_id in enumerate(index.ids) if doc_id is not None}
+        index.lengths.frombytes(data["lengths"])
+        index.packed = (
+            dict(zip(data["grams"], range(len(data["grams"])))),
+            data["offsets"], data["rows"], data["tfs"]
+        )
+        return index
+
+def reciprocal_rank_fusion(rankings:list, k:int=60) -> list:
+    """
+        倒数排名融合，rankings 为若干个按相关度排列的 id 列表
+
+        返回：按融合分数从高到低排列的 id 列表
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda x: scores[x], reverse=True)
@@ -0,0 +1,179 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from langchain_core.documents import Document
+
+from cache import QueryCache
+from embedding import Embedding, create_embedding_model
+from dispatcher import EmbeddingDispatcher
+
+"""
+    多向量库管理
+"""
+
+class EmbeddingManager:
+    """
+        管理多个命名向量库，所有向量库共享同一个嵌入模型、查询向量缓存和查询批处理
+        向量库在第一次被使用时才加载，所有已加载向量库的内存估计值超过 memory_budget 时，
+        卸载最久未使用的向量库
+        lock 只保护 dbs、usage 和 loading，加载向量库和等待后台合并都在锁外进行，
+        不会阻塞对其它向量库的查询
+    """
+    size, cover = 512, 128
+    memory_budget: int = 2*1024*1024*1024
+    embedding_model = None
+    query_cache = None
+    dispatcher = None
+    dbs = None
+    usage = None
+    loading = None
+    options: dict = {}
+    lock = None
+
+    def __init__(
+        self, size:int=512, cover:int=128, memory_budget:int=2*1024*1024*1024,
+        query_cache_size:int=1024, query_cache_ttl:float=None, batch_window:float=None, **options
+    ):
+        """
+            size, cover: 与 Embedding 相同
+            memory_budget: 已加载向量库的内存预算（字节），见 Embedding.memory_usage
+            batch_window: 与 Embedding 相同，所有向量库的查询一起合并
+            options: 其它传给 Embedding 的参数，如 cache_path、mmap
+        """
+        self.size, self.cover, self.memory_budget = size, cover, memory_budget
+        self.options = options
+        self.embedding_model = create_embedding_model(size)
+        self.query_cache = QueryCache(query_cache_size, query_cache_ttl) if query_cache_size > 0 else None
+        if batch_window is not None:
+            self.dispatcher = EmbeddingDispatcher(self.embedding_model, batch_window)
+        self.dbs, self.usage, self.loading = OrderedDict(), {}, {}
+        self.lock = threading.RLock()
+
+    def __contains__(self, db_name:str) -> bool:
+        return db_name in self.dbs
+
+    def get(self, db_name:str) -> Embedding:
+        """
+            取得向量库，未加载时加载它
+            同一个向量库只会被加载一次，同时请求它的线程等待 loading 中的 Future
+        """
+        with self.lock:
+            if db_name in self.dbs:
+                self.dbs.move_to_end(db_name)
+                return self.dbs[db_name]
+            future = self.loading.get(db_name)
+            owner = future is None
+            if owner:
+                future = self.loading[db_name] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            print("Loading vector store: {}".format(db_name))
+            db = Embedding(
+                self.size, self.cover, db_name,
+                embedding_model = self.embedding_model,
+                query_cache_size = 0,
+                **self.options
+            )
+            db.query_cache = self.query_cache
+            db.dispatcher = self.dispatcher
+        except BaseException as e:
+            with self.lock:
+                self.loading.pop(db_name, None)
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.loading.pop(db_name, None)
+            self.dbs[db_name] = db
+            self.usage[db_name] = db.memory_usage()
+        future.set_result(db)
+        self.evict(keep=db_name)
+        return db
+
+    def load(self, db_name:str, paths:list, **kwargs) -> bool:
+        """
+            向某个向量库中加载文件
+        """
+        db = self.get(db_name)
+        result = db.load(paths, **kwargs)
+        with self.lock:
+            # 加载期间向量库可能已经被卸载
+            if self.dbs.get(db_name) is db:
+                self.usage[db_name] = db.memory_usage()
+        self.evict(keep=db_name)
+        return result
+
+    def unload(self, db_name:str):
+        with self.lock:
+            db = self.dbs.pop(db_name, None)
+            self.usage.pop(db_name, None)
+        if db is not None:
+            # 等待后台合并完成，避免丢失未写入的快照
+            db.store.wait()
+
+    def evict(self, keep:str=None):
+        """
+            卸载最久未使用的向量库，直到内存估计值不超过预算，keep 指定的向量库不会被卸载
+            在锁内移出向量库，释放锁后再等待它们的后台合并完成
+        """
+        unloaded = []
+        with self.lock:
+            for db_name in list(self.dbs.keys()):
+                if sum(self.usage.values()) <= self.memory_budget:
+                    break
+                if db_name != keep:
+                    print("Unloading vector store: {}".format(db_name))
+                    unloaded.append(self.dbs.pop(db_name))
+                    self.usage.pop(db_name, None)
+        for db in unloaded:
+            # 等待后台合并完成，避免丢失未写入的快照
+            db.store.wait()
+
+    def memory_usage(self) -> int:
+        return sum(self.usage.values())
+
+    def search(self, db_name:str, query:str, **kwargs) -> list:
+        """
+            在指定的向量库中搜索，参数与 Embedding.search 相同
+        """
+        return self.get(db_name).search(query, **kwargs)
+
+    def search_all(self, query:str, db_names:list, k:int=5, threshold:float=None) -> list:
+        """
+            在多个向量库中搜索，按余弦相似度合并结果，查询向量只计算一次
+            db_names: 要搜索的向量库名称列表
+            threshold: 余弦相似度阈值，为 None 时不过滤
+
+            返回：最相似的 k 个文档，metadata 中的 db 字段为文档所在的向量库
+        """
+        hits, loaded = [], {}
+        for db_name in db_names:
+            db = loaded[db_name] = self.get(db_name)
+            if db.vec_db is None:
+                continue
+            result = db.vector_search([query], k)[0]
+            similarity = db.similarity([score for _, score in result])
+            for (_id, _), score in zip(result, similarity):
+                if threshold is None or score > threshold:
+                    hits.append((float(score), db_name, _id))
+        hits.sort(key=lambda x: x[0], reverse=True)
+
+        docs, seen = [], set()
+        for score, db_name, _id in hits:
+            db = loaded[db_name]
+            doc = db.vec_db.docstore.search(_id)
+            # 问题布局下，同一个答案只保留一次
+            key = (db_name, doc.metadata.get("answer_id", _id))
+            if key in seen:
+                continue
+            seen.add(key)
+            doc = db.resolve([doc])[0]
+            docs.append(Document(
+                page_content = doc.page_content,
+                metadata = dict(doc.metadata, db=db_name, score=score)
+            ))
+            if len(docs) >= k:
+                break
+        return docs
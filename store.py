@@ -0,0 +1,694 @@
+import os
+import json
+import mmap
+import pickle
+import shutil
+import threading
+from collections.abc import Mapping
+
+import faiss
+import numpy as np
+
+from lexical import NGramIndex
+
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+"""
+    增量持久化的向量库存储
+"""
+
+# 基础快照包含的文件
+base_suffixes = [
+    ".faiss", ".pkl", ".lexical.pkl", ".sources.json",
+    ".docs.bin", ".docs.offsets.npy", ".docs.ids.npy", ".docs.sorted.npy"
+]
+
+# 各类索引的默认参数
+index_defaults = {
+    "flat": {},
+    "ivf": {"nlist": 100, "nprobe": 10},
+    "hnsw": {"M": 32, "efConstruction": 40, "efSearch": 64}
+}
+
+# 各种向量压缩方式的默认参数
+codec_defaults = {
+    "float32": {},
+    "float16": {},
+    "int8": {},
+    "pq": {"pq_m": 64, "pq_nbits": 8}
+}
+
+def index_config(index_type:str="flat", index_params:dict=None, codec:str="float32", metric:str="l2") -> dict:
+    """
+        合并默认参数，返回 {"type": 索引类型, "codec": 压缩方式, "metric": 距离, "params": 参数}
+    """
+    if index_type not in index_defaults:
+        raise ValueError("Unsupported index type: {}".format(index_type))
+    if codec not in codec_defaults:
+        raise ValueError("Unsupported codec: {}".format(codec))
+    if metric not in ["l2", "ip"]:
+        raise ValueError("Unsupported metric: {}".format(metric))
+    params = dict(index_defaults[index_type])
+    params.update(codec_defaults[codec])
+    params.update({"refine": None, "k_factor": 4})
+    params.update(index_params or {})
+    return {"type": index_type, "codec": codec, "metric": metric, "params": params}
+
+def store_kwargs(config:dict) -> dict:
+    """
+        创建 LangChain FAISS 对象时，与距离相关的参数
+        ip 索引中的向量都会被归一化，内积即为余弦相似度
+    """
+    if config["metric"] == "ip":
+        return {"normalize_L2": True, "distance_strategy": DistanceStrategy.MAX_INNER_PRODUCT}
+    return {}
+
+def create_index(dim:int, config:dict, vectors=None):
+    """
+        根据配置创建 FAISS 索引
+        dim: 向量维度
+        config: index_config 返回的索引配置
+        vectors: 训练向量，IVF 索引和 int8、pq 压缩需要用它训练
+
+        索引类型：
+            flat: 暴力搜索
+            ivf: 倒排索引，nlist 为聚类中心数量，nprobe 为搜索时访问的聚类数量
+            hnsw: 分层可导航小世界图，M 为每个节点的邻居数量，efSearch 为搜索时的候选队列长度
+        压缩方式：
+            float32: 不压缩
+            float16: 半精度浮点数，每维 2 字节
+            int8: 标量量化，每维 1 字节
+            pq: 乘积量化，每个向量 pq_m * pq_nbits / 8 字节，pq_m 需要整除向量维度
+        训练向量少于 train_size 时暂时返回同样距离的暴力搜索索引，见 is_staging，
+        向量足够后在合并时按配置重建，配置中的参数不会被修改
+        精排：
+            refine 为 flat 或 float16 时，额外保存对应精度的向量，
+            先取出 k * k_factor 个候选，再用精确距离重新排序
+        距离：
+            l2: 欧氏距离的平方，越小越相似
+            ip: 归一化向量的内积，即余弦相似度，越大越相似
+    """
+    params = config["params"]
+    if config["codec"] == "float32":
+        storage = "Flat"
+    elif config["codec"] == "float16":
+        storage = "SQfp16"
+    elif config["codec"] == "int8":
+        storage = "SQ8"
+    else:
+        storage = "PQ{}x{}".format(params["pq_m"], params["pq_nbits"])
+
+    if config["type"] == "flat":
+        description = storage
+    elif config["type"] == "ivf":
+        description = "IVF{},{}".format(params["nlist"], storage)
+    else:
+        description = "HNSW{}".format(params["M"]) + ("" if storage == "Flat" else "," + storage)
+
+    if params["refine"] == "flat":
+        description += ",RFlat"
+    elif params["refine"] == "float16":
+        description += ",Refine(SQfp16)"
+    elif params["refine"] is not None:
+        raise ValueError("Unsupported refine: {}".format(params["refine"]))
+
+    metric = faiss.METRIC_INNER_PRODUCT if config["metric"] == "ip" else faiss.METRIC_L2
+    index = faiss.index_factory(dim, description, metric)
+    if config["type"] == "hnsw":
+        base = faiss.downcast_index(index.base_index) if params["refine"] is not None else index
+        base.hnsw.efConstruction = params["efConstruction"]
+    if not index.is_trained:
+        if vectors is None:
+            raise ValueError("{} 索引需要训练向量".format(description))
+        if len(vectors) < train_size(config):
+            print("Warning: 训练向量只有 {} 个，少于 {} 需要的 {} 个，暂时使用暴力搜索，向量足够后合并时重建索引".format(
+                len(vectors), description, train_size(config)))
+            return faiss.IndexFlat(dim, metric)
+        vectors = np.array(vectors, dtype=np.float32)
+        if config["metric"] == "ip":
+            faiss.normalize_L2(vectors)
+        index.train(vectors)
+    tune_index(index, config)
+    return index
+
+def train_size(config:dict) -> int:
+    """
+        返回：按配置训练索引至少需要的向量数量，不需要训练时为 0
+    """
+    params, n = config["params"], 0
+    if config["type"] == "ivf":
+        n = max(n, params["nlist"])
+    if config["codec"] == "int8":
+        n = max(n, 1)
+    elif config["codec"] == "pq":
+        n = max(n, 2 ** params["pq_nbits"])
+    return n
+
+def is_staging(index, config:dict) -> bool:
+    """
+        返回：index 是否为训练向量不足时暂时使用的暴力搜索索引，见 create_index
+    """
+    return train_size(config) > 0 and isinstance(faiss.downcast_index(index), faiss.IndexFlat)
+
+def tune_index(index, config:dict):
+    """
+        设置搜索时使用的参数
+    """
+    if is_staging(index, config):
+        return
+    params = config["params"]
+    if config["type"] == "ivf":
+        faiss.ParameterSpace().set_index_parameter(index, "nprobe", params["nprobe"])
+        # 建立直接映射，使得可以按序号取回向量
+        faiss.extract_index_ivf(index).make_direct_map()
+    elif config["type"] == "hnsw":
+        faiss.ParameterSpace().set_index_parameter(index, "efSearch", params["efSearch"])
+    if params.get("refine") is not None:
+        faiss.ParameterSpace().set_index_parameter(index, "k_factor_rf", params["k_factor"])
+
+def search_params(index, selector):
+    """
+        构造只搜索 selector 选中的向量的搜索参数，nprobe、efSearch、k_factor 与 index 当前的设置相同
+
+        返回：不支持过滤的索引（如 pq 压缩的 flat 索引）返回 None
+    """
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexRefine):
+        base = search_params(index.base_index, selector)
+        if base is None:
+            return None
+        params = faiss.IndexRefineSearchParameters()
+        params.base_index_params = base
+        params.k_factor = index.k_factor
+    elif isinstance(index, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF()
+        params.nprobe = index.nprobe
+    elif isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = index.hnsw.efSearch
+    elif isinstance(index, (faiss.IndexFlat, faiss.IndexScalarQuantizer)):
+        params = faiss.SearchParameters()
+    else:
+        return None
+    params.sel = selector
+    # SWIG 对象不持有 selector 和 base 的引用，需要保留它们，避免被回收
+    params.referenced_objects = [selector] + ([base] if isinstance(index, faiss.IndexRefine) else [])
+    return params
+
+class MmapDocstore(Docstore):
+    """
+        以内存映射方式读取的只读文档库，文件结构：
+            {prefix}.docs.bin           所有文档依次以 JSON 编码拼接而成
+            {prefix}.docs.offsets.npy   每个文档在 docs.bin 中的起始位置，共 n+1 项
+            {prefix}.docs.ids.npy       每个文档的 id，与索引中的向量顺序一致
+            {prefix}.docs.sorted.npy    按 id 排序后的文档序号，用于二分查找
+        只有被搜索到的文档才会被读取和解码
+    """
+    ids = None
+    offsets = None
+    order = None
+    blob = None
+
+    def __init__(self, prefix:str):
+        self.ids = np.load(prefix + ".docs.ids.npy", mmap_mode="r")
+        self.offsets = np.load(prefix + ".docs.offsets.npy", mmap_mode="r")
+        self.order = np.load(prefix + ".docs.sorted.npy", mmap_mode="r")
+        with open(prefix + ".docs.bin", "rb") as f:
+            # 空文件无法映射
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] > 0 else b""
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row(self, search:str) -> int:
+        """
+            二分查找 id 对应的文档序号，找不到时返回 -1
+        """
+        key = search.encode()
+        low, high = 0, len(self.order)
+        while low < high:
+            mid = (low + high) // 2
+            if self.ids[self.order[mid]] < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self.order) and self.ids[self.order[low]] == key:
+            return int(self.order[low])
+        return -1
+
+    def document(self, row:int) -> Document:
+        record = json.loads(self.blob[self.offsets[row] : self.offsets[row+1]].decode())
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def search(self, search:str):
+        row = self.row(search)
+        if row < 0:
+            return f"ID {search} not found."
+        return self.document(row)
+
+    @staticmethod
+    def write(prefix:str, docstore, index_to_docstore_id:dict):
+        """
+            将文档库按向量顺序写为内存映射文件
+        """
+        ids = [index_to_docstore_id[i] for i in range(len(index_to_docstore_id))]
+        offsets = [0]
+        with open(prefix + ".docs.bin", "wb") as f:
+            for _id in ids:
+                doc = docstore.search(_id)
+                data = json.dumps(
+                    {"page_content": doc.page_content, "metadata": doc.metadata},
+                    ensure_ascii=False
+                ).encode()
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+        ids = np.array([i.encode() for i in ids], dtype=bytes)
+        np.save(prefix + ".docs.offsets.npy", np.array(offsets, dtype=np.int64))
+        np.save(prefix + ".docs.ids.npy", ids)
+        np.save(prefix + ".docs.sorted.npy", np.argsort(ids, kind="stable").astype(np.int64))
+
+class MmapIdMap(Mapping):
+    """
+        向量序号到文档 id 的只读映射，直接读取内存映射的 id 数组
+    """
+    ids = None
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __getitem__(self, i:int) -> str:
+        if i < 0 or i >= len(self.ids):
+            raise KeyError(i)
+        return self.ids[i].decode()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(range(len(self.ids)))
+
+class AnswerStore:
+    """
+        问答对的答案表，按答案的 md5 值去重，以追加方式保存在 answers.jsonl 中
+        向量库中只保存问题和 answer_id，搜索到任意一个问题都会得到同一个答案
+    """
+    path: str
+    answers: dict = {}
+    pending: list = []
+
+    def __init__(self, path:str):
+        self.path = path
+        self.answers, self.pending = {}, []
+        if os.path.exists(os.path.join(path, "answers.jsonl")):
+            with open(os.path.join(path, "answers.jsonl"), "r", encoding="utf-8") as f:
+                for line in f:
+                    item = json.loads(line)
+                    self.answers[item["id"]] = item["answer"]
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    def get(self, answer_id:str) -> str:
+        return self.answers.get(answer_id, "")
+
+    def add(self, answer_id:str, answer:str):
+        if answer_id not in self.answers:
+            self.answers[answer_id] = answer
+            self.pending.append(answer_id)
+
+    def flush(self):
+        """
+            将新加入的答案追加写入磁盘
+        """
+        if len(self.pending) == 0:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "answers.jsonl"), "a", encoding="utf-8") as f:
+            for answer_id in self.pending:
+                f.write(json.dumps({"id": answer_id, "answer": self.answers[answer_id]}, ensure_ascii=False) + "\n")
+        self.pending = []
+
+class SegmentStore:
+    """
+        以“基础快照 + 增量段”的方式保存 FAISS 向量库，目录结构：
+            faiss_{name}/
+                manifest.json           清单，记录当前的基础快照和增量段
+                {base}.faiss            基础快照的索引（与 FAISS.save_local 格式相同）
+                {base}.pkl              基础快照的文档库
+                {base}.lexical.pkl      基础快照的关键词倒排索引
+                {base}.sources.json     基础快照的来源索引，{文件路径: 文本块 id 列表}
+                segments/{n}.npy        第 n 个增量段的向量
+                segments/{n}.json       第 n 个增量段的文本、元数据和 id，以及来源索引的变化和被删除的 id
+                answers.jsonl           问题布局的 qa 向量库的答案表，见 AnswerStore
+                files.json              已加载文件的清单，{文件路径: 大小、修改时间、内容哈希、划分参数}
+
+        加入新文档时只写入一个增量段和清单，不再重写整个索引
+        增量段过多时，在后台线程中将当前向量库合并为新的基础快照
+        没有 manifest.json 的旧向量库目录，会被当作基础快照为 index 的向量库
+    """
+    path: str
+    max_segments: int = 16
+    manifest: dict = {}
+    files: dict = {}
+    lock = None
+    compacting = None
+
+    def __init__(self, path:str, max_segments:int=16):
+        """
+            path: 向量库目录
+            max_segments: 增量段数量达到该值时，自动在后台合并
+        """
+        self.path, self.max_segments = path, max_segments
+        self.lock = threading.RLock()
+        self.compacting = None
+        if os.path.exists(os.path.join(path, "manifest.json")):
+            with open(os.path.join(path, "manifest.json"), "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        elif os.path.exists(os.path.join(path, "index.faiss")):
+            self.manifest = {"base": "index", "version": 0, "segments": []}
+        else:
+            self.manifest = {"base": None, "version": 0, "segments": []}
+        # 旧的向量库都是不压缩的暴力搜索索引
+        self.manifest.setdefault("index", index_config("flat"))
+        self.manifest["index"].setdefault("codec", "float32")
+        self.manifest["index"].setdefault("metric", "l2")
+        self.files = {}
+        if os.path.exists(os.path.join(path, "files.json")):
+            with open(os.path.join(path, "files.json"), "r", encoding="utf-8") as f:
+                self.files = json.load(f)
+
+    def exists(self) -> bool:
+        return self.manifest["base"] is not None or len(self.manifest["segments"]) > 0
+
+    def write_json(self, name:str, data):
+        """
+            原子地写入 JSON 文件
+        """
+        os.makedirs(self.path, exist_ok=True)
+        temp = os.path.join(self.path, name + ".tmp")
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp, os.path.join(self.path, name))
+
+    def write_manifest(self):
+        """
+            原子地写入清单
+        """
+        self.write_json("manifest.json", self.manifest)
+
+    def write_files(self):
+        """
+            原子地写入文件清单
+        """
+        with self.lock:
+            self.write_json("files.json", self.files)
+
+    def load_base(self, embedding_model) -> FAISS:
+        """
+            加载基础快照，没有基础快照时返回 None
+        """
+        if self.manifest["base"] is None:
+            return None
+        vec_db = FAISS.load_local(
+            self.path, embedding_model, index_name=self.manifest["base"], **store_kwargs(self.manifest["index"]))
+        tune_index(vec_db.index, self.manifest["index"])
+        return vec_db
+
+    def load_mmap(self, embedding_model) -> FAISS:
+        """
+            以只读内存映射方式加载基础快照，索引和文档都不会被完整读入内存
+            多个进程加载同一个向量库时可以共享相同的内存页
+        """
+        if self.manifest["base"] is None:
+            return None
+        prefix = os.path.join(self.path, self.manifest["base"])
+        if not os.path.exists(prefix + ".docs.bin"):
+            raise FileNotFoundError(
+                "向量库 {} 没有内存映射文档库，请先调用 save() 生成".format(self.path))
+        if len(self.manifest["segments"]) > 0:
+            print("Warning: {} 中有 {} 个增量段未合并，内存映射模式下不会加载，请先调用 save() 合并".format(
+                self.path, len(self.manifest["segments"])))
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+        index = faiss.read_index(prefix + ".faiss", flags)
+        tune_index(index, self.manifest["index"])
+        docstore = MmapDocstore(prefix)
+        return FAISS(
+            embedding_function = embedding_model,
+            index = index,
+            docstore = docstore,
+            index_to_docstore_id = MmapIdMap(docstore.ids),
+            **store_kwargs(self.manifest["index"])
+        )
+
+    def load_lexical(self) -> NGramIndex:
+        """
+            加载基础快照的关键词倒排索引，不存在时返回 None
+        """
+        if self.manifest["base"] is None:
+            return None
+        name = os.path.join(self.path, self.manifest["base"] + ".lexical.pkl")
+        if not os.path.exists(name):
+            return None
+        with open(name, "rb") as f:
+            return NGramIndex.loads(f.read())
+
+    def write_lexical(self, lexical:NGramIndex):
+        """
+            为没有保存倒排索引的旧基础快照补写倒排索引，lexical 必须只包含基础快照中的文档
+            快照中原来没有这个文件，写入临时文件后原子地重命名，不会修改已有的快照文件
+        """
+        with self.lock:
+            if self.manifest["base"] is None:
+                return
+            name = os.path.join(self.path, self.manifest["base"] + ".lexical.pkl")
+            if os.path.exists(name):
+                return
+            with open(name + ".tmp", "wb") as f:
+                f.write(lexical.dumps())
+            os.replace(name + ".tmp", name)
+
+    def load_sources(self) -> dict:
+        """
+            加载基础快照的来源索引，不存在时返回 None
+        """
+        if self.manifest["base"] is None:
+            return None
+        name = os.path.join(self.path, self.manifest["base"] + ".sources.json")
+        if not os.path.exists(name):
+            return None
+        with open(name, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def segments(self):
+        """
+            依次读取增量段
+
+            返回：(texts, embeddings, metadatas, ids, sources, removed) 的迭代器
+                sources 为这个段更新的 {文件路径: 文本块 id 列表}，removed 为这个段删除的文本块 id
+        """
+        for n in list(self.manifest["segments"]):
+            name = os.path.join(self.path, "segments", "{:06d}".format(n))
+            embeddings = np.load(name + ".npy")
+            with open(name + ".json", "r", encoding="utf-8") as f:
+                segment = json.load(f)
+            yield (
+                segment["texts"], embeddings, segment["metadatas"], segment["ids"],
+                segment.get("sources", {}), segment.get("removed", [])
+            )
+
+    def append(self, texts:list, embeddings:list, metadatas:list, ids:list, sources:dict=None, removed:list=None):
+        """
+            写入一个新的增量段
+            sources: 来源索引的变化，{文件路径: 文本块 id 列表}
+            removed: 被删除的文本块 id
+        """
+        with self.lock:
+            os.makedirs(os.path.join(self.path, "segments"), exist_ok=True)
+            n = self.manifest["version"] + 1
+            name = os.path.join(self.path, "segments", "{:06d}".format(n))
+            np.save(name + ".npy", np.asarray(embeddings, dtype=np.float32))
+            with open(name + ".json", "w", encoding="utf-8") as f:
+                json.dump({
+                    "texts": texts, "metadatas": metadatas, "ids": ids,
+                    "sources": sources or {}, "removed": removed or []
+                }, f, ensure_ascii=False)
+            self.manifest["version"] = n
+            self.manifest["segments"].append(n)
+            self.write_manifest()
+
+    def compact(self, vec_db:FAISS, lexical:NGramIndex=None, background:bool=True, sources:dict=None):
+        """
+            将当前向量库保存为新的基础快照，并删除已经合并的增量段
+            vec_db: 当前的向量库，必须包含所有增量段的内容
+            lexical: 与向量库对应的关键词倒排索引
+            background: 是否在后台线程中写入磁盘
+            sources: 与向量库对应的来源索引，{文件路径: 文本块 id 集合}
+        """
+        if self.compacting is not None and self.compacting.is_alive():
+            if not background:
+                self.compacting.join()
+            else:
+                return
+        with self.lock:
+            # 在锁内复制索引和文档库，之后的写入不会影响这次合并
+            version = self.manifest["version"]
+            index = faiss.serialize_index(vec_db.index)
+            docstore = pickle.dumps((vec_db.docstore, vec_db.index_to_docstore_id))
+            lexical = lexical.dumps() if lexical is not None else None
+            if sources is not None:
+                sources = json.dumps({path: sorted(ids) for path, ids in sources.items()}, ensure_ascii=False)
+        if background:
+            self.compacting = threading.Thread(
+                target=self.write_base, args=(version, index, docstore, lexical, sources), daemon=True)
+            self.compacting.start()
+        else:
+            self.write_base(version, index, docstore, lexical, sources)
+
+    def write_base(self, version:int, index, docstore:bytes, lexical:bytes=None, sources:str=None):
+        """
+            写入新的基础快照，写完后才原子地替换清单
+            快照文件写入后不会再被修改：同一版本再次合并时使用新的文件名，
+            旧快照可能正被内存映射的读者或其它版本目录中的硬链接使用，只能在清单替换后删除
+        """
+        os.makedirs(self.path, exist_ok=True)
+        base, n = "index_{:06d}".format(version), 0
+        while any(os.path.exists(os.path.join(self.path, base + suffix)) for suffix in base_suffixes):
+            n += 1
+            base = "index_{:06d}_{}".format(version, n)
+        with open(os.path.join(self.path, base + ".faiss"), "wb") as f:
+            f.write(index.tobytes())
+        with open(os.path.join(self.path, base + ".pkl"), "wb") as f:
+            f.write(docstore)
+        MmapDocstore.write(os.path.join(self.path, base), *pickle.loads(docstore))
+        if lexical is not None:
+            with open(os.path.join(self.path, base + ".lexical.pkl"), "wb") as f:
+                f.write(lexical)
+        if sources is not None:
+            with open(os.path.join(self.path, base + ".sources.json"), "w", encoding="utf-8") as f:
+                f.write(sources)
+
+        with self.lock:
+            old_base = self.manifest["base"]
+            merged = [n for n in self.manifest["segments"] if n <= version]
+            self.manifest["base"] = base
+            self.manifest["segments"] = [n for n in self.manifest["segments"] if n > version]
+            self.write_manifest()
+
+        # 清单更新后，旧的快照和增量段不再被引用，可以删除
+        if old_base is not None and old_base != base:
+            for suffix in base_suffixes:
+                if os.path.exists(os.path.join(self.path, old_base + suffix)):
+                    os.remove(os.path.join(self.path, old_base + suffix))
+        for n in merged:
+            for suffix in [".npy", ".json"]:
+                name = os.path.join(self.path, "segments", "{:06d}".format(n) + suffix)
+                if os.path.exists(name):
+                    os.remove(name)
+
+    def need_compact(self) -> bool:
+        return len(self.manifest["segments"]) >= self.max_segments
+
+    def wait(self):
+        """
+            等待后台合并完成
+        """
+        if self.compacting is not None:
+            self.compacting.join()
+
+
+def link_or_copy(src:str, dst:str):
+    """
+        复制向量库文件时优先使用硬链接：快照和增量段写入后不会再被修改，
+        合并总是写入新的快照文件名（见 SegmentStore.write_base），清单都是原子替换的
+        只有追加写入的答案表需要真正复制
+    """
+    if os.path.basename(src) != "answers.jsonl":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+class StoreVersions:
+    """
+        向量库的多个版本，用于在后台重建向量库并原子地切换，目录结构：
+            {path}/
+                CURRENT         当前版本的目录名，原子地替换
+                v{n}/           每个版本都是一个完整的向量库目录，见 SegmentStore
+
+        新版本由当前版本复制而来（硬链接，几乎不占用时间和空间），在新目录中加入文件，
+        构建完成后才写入 CURRENT，读取 CURRENT 的进程永远不会看到构建到一半的向量库
+    """
+    path: str
+    keep: int = 3
+
+    def __init__(self, path:str, keep:int=3):
+        """
+            path: 版本目录
+            keep: 最多保留的版本数量
+        """
+        self.path, self.keep = path, keep
+
+    def versions(self) -> list:
+        """
+            返回：所有版本的目录名，从旧到新排列
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return sorted([
+            name for name in os.listdir(self.path)
+            if name.startswith("v") and os.path.isdir(os.path.join(self.path, name))
+        ])
+
+    def current(self) -> str:
+        """
+            返回：当前版本的目录，没有版本时返回 None
+        """
+        name = os.path.join(self.path, "CURRENT")
+        if not os.path.exists(name):
+            return None
+        with open(name, "r", encoding="utf-8") as f:
+            return os.path.join(self.path, f.read().strip())
+
+    def create(self, base:str=None) -> str:
+        """
+            新建一个版本目录
+            base: 作为起点的向量库目录，为 None 时新建空的向量库
+
+            返回：新版本的目录
+        """
+        versions = self.versions()
+        n = int(versions[-1][1:]) + 1 if len(versions) > 0 else 1
+        path = os.path.join(self.path, "v{:06d}".format(n))
+        if base is not None and os.path.isdir(base):
+            shutil.copytree(base, path, copy_function=link_or_copy)
+        else:
+            os.makedirs(path)
+        return path
+
+    def publish(self, path:str, protect:list=None):
+        """
+            原子地将 path 设为当前版本，并删除多余的旧版本
+            protect: 清理旧版本时需要保留的版本目录，如用于回滚的上一个版本
+        """
+        temp = os.path.join(self.path, "CURRENT.tmp")
+        with open(temp, "w", encoding="utf-8") as f:
+            f.write(os.path.basename(path))
+        os.replace(temp, os.path.join(self.path, "CURRENT"))
+        self.prune(protect)
+
+    def prune(self, protect:list=None):
+        """
+            只保留最新的 keep 个版本，当前版本和 protect 中的版本总会被保留
+        """
+        current = self.current()
+        kept = {os.path.basename(os.path.normpath(path)) for path in (protect or [])}
+        if current is not None:
+            kept.add(os.path.basename(current))
+        for name in self.versions()[:-self.keep]:
+            if name not in kept:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)